@@ -0,0 +1,239 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import unittest
+import traceback
+import cStringIO
+
+from yggdrasil import diskspec
+from yggdrasil import report
+from yggdrasil import solver
+from yggdrasil import solver_utils as sutils
+from yggdrasil import test
+
+
+# Run the given tests, saving every query to `outdir` instead of
+# solving it.  Queries are sent from forked children, so they go
+# through the file system.
+def capture_queries(module, names, outdir):
+    def _solve(self, *args, **kwargs):
+        fd, path = tempfile.mkstemp(suffix='.smt2', dir=outdir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(solver.to_smt2(*args))
+
+    # Obligations of a match_ method, with shared execution
+    def _discharge(self, session, shared, obligations):
+        for o in obligations:
+            _solve(self, *(shared + o.terms))
+
+    mod = __import__(module)
+    old = test.DiskTest._solve, test.RefinementTest._discharge
+    test.DiskTest._solve = _solve
+    test.RefinementTest._discharge = _discharge
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromNames(names, mod)
+        suite.run(unittest.TestResult())
+    finally:
+        test.DiskTest._solve, test.RefinementTest._discharge = old
+
+    queries = []
+    for path in sorted(glob.glob(os.path.join(outdir, '*.smt2'))):
+        with open(path) as f:
+            queries.append(f.read())
+    return queries
+
+
+def timeit(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench_protocol(args):
+    tests = args or ['DirRefinementTest.test_match_mknod',
+                     'DirRefinementTest.test_match_rename']
+    tmp = tempfile.mkdtemp()
+    try:
+        queries = capture_queries('test_dirspec', tests, tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+    total = sum(map(len, queries))
+    print "%d test_dirspec queries, %d bytes of SMT-LIB" % (len(queries), total)
+    print "%-16s %12s %12s %12s" % ('framing', 'bytes', 'encode (s)', 'decode (s)')
+
+    for protocol, compress in [('json', False), ('binary', False), ('binary', True)]:
+        def encode():
+            out = cStringIO.StringIO()
+            for q in queries:
+                sutils.write_cmd(out, {'name': 'add', 'args': [q], 'kwargs': {}},
+                        protocol=protocol, compress=compress)
+            return out
+
+        data = encode().getvalue()
+
+        def decode():
+            inp = cStringIO.StringIO(data)
+            while sutils.read_cmd(inp) is not None:
+                pass
+
+        name = protocol + ('+zlib' if compress else '')
+        print "%-16s %12d %12.4f %12.4f" % (name, len(data), timeit(encode), timeit(decode))
+
+
+# Wall-clock time of running the given tests without solving anything
+def frontend_time(mod, tests):
+    def nop(self, *args, **kwargs):
+        pass
+
+    old = test.DiskTest._solve, test.RefinementTest._discharge
+    test.DiskTest._solve = nop
+    test.RefinementTest._discharge = nop
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromNames(tests, mod)
+        start = time.time()
+        suite.run(unittest.TestResult())
+        return time.time() - start
+    finally:
+        test.DiskTest._solve, test.RefinementTest._discharge = old
+
+
+# Time symbolic execution alone (no solving) of match_ methods, with
+# and without shared execution of their obligations.
+def bench_frontend(args):
+    module = args[0] if args else 'test_dirspec'
+    matches = args[1:] or ['DirRefinementTest.match_mknod']
+
+    mod = __import__(module)
+    old = test.RefinementTest.SHARED_EXECUTION
+    print "%-50s %12s %12s" % ('match', 'separate (s)', 'shared (s)')
+    try:
+        for m in matches:
+            cls, name = m.split('.')
+            tests = ['%s.test_%s' % (cls, name),
+                     '%s.test_%s_crash' % (cls, name),
+                     '%s.test_%s_pre' % (cls, name)]
+            times = []
+            for shared in [False, True]:
+                test.RefinementTest.SHARED_EXECUTION = shared
+                times.append(frontend_time(mod, tests))
+            print "%-50s %12.2f %12.2f" % (m, times[0], times[1])
+    finally:
+        test.RefinementTest.SHARED_EXECUTION = old
+
+
+# Front-end time with the stacks of control variables captured as
+# before (traceback.extract_stack), lazily, or not at all.
+def bench_stacks(args):
+    tests = args or ['test_waldisk:WALDiskTestRefinement.test_match_writev',
+                     'test_dirspec:DirRefinementTest.test_match_rename']
+
+    def eager(depth=0):
+        return traceback.extract_stack()[:-(depth + 1)]
+
+    old = diskspec.capture_stack, diskspec.resolve_stack, diskspec.CAPTURE_STACKS
+    print "%-60s %10s %10s %10s" % ('test', 'eager (s)', 'lazy (s)', 'off (s)')
+    try:
+        for t in tests:
+            module, name = t.split(':')
+            mod = __import__(module)
+            times = []
+            for capture, resolve, enabled in [(eager, list, True), old[:2] + (True,),
+                                              old[:2] + (False,)]:
+                diskspec.capture_stack = capture
+                diskspec.resolve_stack = resolve
+                diskspec.CAPTURE_STACKS = enabled
+                times.append(min(frontend_time(mod, [name]) for _ in range(3)))
+            print "%-60s %10.2f %10.2f %10.2f" % ((t,) + tuple(times))
+    finally:
+        diskspec.capture_stack, diskspec.resolve_stack, diskspec.CAPTURE_STACKS = old
+
+
+# Total verification time of the given tests without and with state
+# merging at the end of each operation.  An operation whose paths do
+# not join runs one path per branch; the last columns tell how many
+# paths (obligations of each kind) each run checked and whether the
+# operation merged.
+def bench_merge(args):
+    tests = args or ['test_waldisk:WALDiskTestRefinement.test_match_writev',
+                     'test_dirspec:DirRefinementTest.test_match_mknod']
+
+    old = test.RefinementTest.MERGE, report.REPORT
+    print "%-60s %10s %10s %7s %7s  %s" % ('test', 'off (s)', 'merge (s)',
+            'paths', 'paths', 'merged')
+    tmp = tempfile.mkdtemp()
+    try:
+        for t in tests:
+            module, name = t.split(':')
+            mod = __import__(module)
+            times, paths = [], []
+            for merge in [False, True]:
+                test.RefinementTest.MERGE = merge
+                # Tests run in forked children; they say what they did
+                # in the report.
+                report.REPORT = os.path.join(tmp, '%s-%d.jsonl' % (t, merge))
+                suite = unittest.defaultTestLoader.loadTestsFromNames([name], mod)
+                result = unittest.TestResult()
+                start = time.time()
+                suite.run(result)
+                times.append(time.time() - start)
+                if not result.wasSuccessful():
+                    print "%s failed with merge=%s" % (t, merge)
+                records = report.load(report.REPORT) if os.path.exists(report.REPORT) else []
+                summary = report.summarize(records).values()
+                paths.append(max([s['paths'] for s in summary] or [0]))
+            # Of the merge run; both if only some operations merged
+            merged = set(r['merge'] for r in records if r.get('merge'))
+            print "%-60s %10.2f %10.2f %7d %7d  %s" % (t, times[0], times[1],
+                    paths[0], paths[1], ','.join(sorted(merged)) or '-')
+    finally:
+        test.RefinementTest.MERGE, report.REPORT = old
+        shutil.rmtree(tmp)
+
+
+# Time to verify whole test files with blocks and disks as
+# uninterpreted functions and as z3 arrays (ufarray.ARRAYS).
+def bench_arrays(args):
+    import verify
+    modules = args or [f[:-3] for f, _ in verify.files]
+
+    old = test.DiskTest.ARRAYS
+    print "%-24s %12s %12s %9s %9s" % ('test file', 'uf (s)', 'arrays (s)', 'failed', 'failed')
+    try:
+        for module in modules:
+            mod = __import__(module)
+            times, failed = [], []
+            for arrays in [False, True]:
+                test.DiskTest.ARRAYS = arrays
+                suite = unittest.defaultTestLoader.loadTestsFromModule(mod)
+                result = unittest.TestResult()
+                start = time.time()
+                suite.run(result)
+                times.append(time.time() - start)
+                failed.append(len(result.failures) + len(result.errors))
+            print "%-24s %12.2f %12.2f %9d %9d" % ((module,) + tuple(times) + tuple(failed))
+    finally:
+        test.DiskTest.ARRAYS = old
+
+
+BENCHMARKS = {
+    'arrays': bench_arrays,
+    'frontend': bench_frontend,
+    'merge': bench_merge,
+    'protocol': bench_protocol,
+    'stacks': bench_stacks,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print "usage: %s {%s} [args...]" % (sys.argv[0], ','.join(sorted(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
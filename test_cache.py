@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+
+from z3 import *
+
+from yggdrasil import cache
+from yggdrasil import solver
+from yggdrasil.util import *
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = cache.ResultCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def query(self):
+        x = FreshBitVec('x', 32)
+        y = FreshBitVec('y', 32)
+        f = Function(fresh_name('f'), BitVecSort(32), BitVecSort(32))
+        i = FreshBitVec('i', 32)
+        return solver.to_smt2(ForAll([i], f(i) == i), f(x) != f(y), x == y)
+
+    def test_normalize(self):
+        q1 = self.query()
+        q2 = self.query()
+        self.assertNotEqual(q1, q2)
+        self.assertEqual(cache.normalize(q1), cache.normalize(q2))
+        self.assertEqual(cache.key(q1), cache.key(q2))
+        self.assertNotEqual(cache.key(q1), cache.key(q1, {'AUTO_CONFIG': False}))
+
+    def test_distinct(self):
+        a = Bool(fresh_name('a'))
+        b = Bool(fresh_name('a'))
+        # a.N and a.M must stay distinct after renaming
+        self.assertNotEqual(cache.key(solver.to_smt2(a, Not(b))),
+                            cache.key(solver.to_smt2(a, Not(a))))
+
+    def test_get_put(self):
+        k = cache.key(self.query())
+        self.assertIsNone(self.cache.get(k))
+        self.cache.put(k, 'unsat')
+        self.assertEqual(self.cache.get(k), 'unsat')
+
+    def test_evict(self):
+        self.cache.size = 0
+        for n in range(4):
+            self.cache.put('%d' % n, 'sat')
+        self.cache.evict()
+        self.assertIsNone(self.cache.get('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
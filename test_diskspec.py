@@ -1,6 +1,7 @@
 from z3 import *
 import disk
 
+import copy
 import unittest
 
 from yggdrasil.util import *
@@ -253,6 +254,34 @@ class VirtualAsyncDiskTest(test.RefinementTest):
         yield (i0, x0)
 
 
+class MachineTest(unittest.TestCase):
+    def test_stack(self):
+        mach = Machine()
+        on = mach.create_on([])
+        synced = mach.create_synced()
+        for b in [on, synced]:
+            filename, lineno, name, line = mach._stack(b)[-1]
+            self.assertEqual(name, 'test_stack')
+            self.assertIn('mach.create_', line)
+
+    def test_ite(self):
+        mach = Machine()
+        on0 = mach.create_on([])
+        a, b = copy.deepcopy(mach), mach
+        synced = a.create_synced()
+        on1 = a.create_on([synced])
+        c = FreshBool('c')
+        m = If(c, a, b)
+        self.assertEqual([str(x) for x in m._ons], [str(on0), str(on1)])
+        self.assertEqual([str(x) for x in m._flushes], [str(synced)])
+        # a's ordering constraints only hold if c
+        s = Solver()
+        s.add(m.assumption, on1, Not(synced))
+        self.assertEqual(s.check(Not(c)), sat)
+        self.assertEqual(s.check(c), unsat)
+        self.assertEqual(s.check(Not(c), m._on != on0), unsat)
+
+
 class InodeSpecTest(test.DiskTest):
     def setUp(self):
         disk.native = False
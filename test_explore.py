@@ -0,0 +1,163 @@
+import unittest
+
+from z3 import *
+import disk
+
+from yggdrasil import explore
+from yggdrasil import test
+from yggdrasil.util import *
+from yggdrasil.ufarray import *
+
+
+class ExplorerTest(unittest.TestCase):
+    def setUp(self):
+        disk.native = False
+
+    def explore(self, fn, **kwargs):
+        e = explore.Explorer(**kwargs)
+        paths = []
+        while e.next():
+            disk.assertion.assertions = []
+            fn(e)
+            paths.append(e.path)
+        return e, sorted(paths)
+
+    def test_paths(self):
+        x = FreshBitVec('x', 8)
+        y = FreshBitVec('y', 8)
+        e, paths = self.explore(lambda e: [e.branch(x == 1), e.branch(y == 1)])
+        self.assertEqual(paths, ['00', '01', '10', '11'])
+        self.assertEqual(e.pruned, 0)
+
+    def test_prune(self):
+        x = FreshBitVec('x', 8)
+        e, paths = self.explore(lambda e: e.branch(x == 1) and e.branch(x == 2))
+        self.assertEqual(paths, ['0', '10'])
+        self.assertEqual(e.pruned, 1)
+
+    def test_replay(self):
+        x = FreshBitVec('x', 8)
+        checked = []
+
+        def fn(e):
+            if e.replay() is None:
+                checked.append(e.path)
+                e.remember([(unsat, None)])
+            e.branch(x == 1)
+            if e.replay() is None:
+                checked.append(e.path)
+                e.remember([(unsat, None)])
+
+        e, paths = self.explore(fn)
+        self.assertEqual(paths, ['0', '1'])
+        self.assertEqual(sorted(checked), ['', '0', '1'])
+
+    def test_limits(self):
+        x = FreshBitVec('x', 8)
+        y = FreshBitVec('y', 8)
+        fn = lambda e: [e.branch(x == 1), e.branch(y == 1)]
+        with self.assertRaises(explore.PathLimit):
+            self.explore(fn, max_paths=3)
+        with self.assertRaises(explore.PathLimit):
+            self.explore(fn, max_depth=1)
+        e, paths = self.explore(fn, max_depth=2, max_paths=4)
+        self.assertEqual(len(paths), 4)
+
+
+class State(object):
+    def __init__(self):
+        self.block = FreshBlock('block')
+        self.size = FreshBitVec('size', 64)
+        self.log = []
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        disk.native = False
+        disk.assertion.assertions = []
+
+    def valid(self, cond):
+        s = Solver()
+        s.add(disk.assertion.assertions)
+        s.add(Not(cond))
+        return s.check() == unsat
+
+    def test_merge(self):
+        x = FreshBitVec('x', 64)
+        s = State()
+        block, size = s.block, s.size
+
+        def fn(s):
+            if x == 1:
+                s.block[0] = x
+                s.size = s.size + 1
+            s.log.append(s.size)
+            return s.size
+
+        ret = explore.merge(fn, s)
+        self.assertEqual(len(s.log), 1)
+        self.assertTrue(self.valid(s.log[0] == ret))
+        self.assertTrue(self.valid(ret == If(x == 1, size + 1, size)))
+        self.assertTrue(self.valid(s.block[0] == If(x == 1, x, block[0])))
+        self.assertTrue(self.valid(s.block[1] == block[1]))
+
+    def test_unmergeable(self):
+        x = FreshBitVec('x', 64)
+        s = State()
+        block, size = s.block, s.size
+
+        def fn(s):
+            s.size = s.size + 1
+            if x == 1:
+                s.log.append(x)
+
+        with self.assertRaises(explore.Unmergeable):
+            explore.merge(fn, s)
+        self.assertEqual(s.log, [])
+        self.assertIs(s.size, size)
+        self.assertIs(s.block, block)
+
+    def test_functions(self):
+        x = FreshBitVec('x', 64)
+        s = State()
+
+        def fn(s):
+            if x == 1:
+                s.log.append(lambda: 1)
+            else:
+                s.log.append(lambda: 2)
+
+        with self.assertRaises(explore.Unmergeable):
+            explore.merge(fn, s)
+        self.assertEqual(s.log, [])
+
+    def test_closure(self):
+        x = FreshBitVec('x', 64)
+        s = State()
+        log = lambda v: s.log.append(v)
+
+        def fn(log):
+            log(x)
+            if x == 1:
+                log(x)
+            else:
+                log(x + 1)
+
+        explore.merge(fn, log)
+        self.assertEqual(len(s.log), 2)
+        self.assertTrue(self.valid(s.log[1] == If(x == 1, x, x + 1)))
+
+
+class WorklistTest(test.DiskTest):
+    WORKLIST = True
+
+    def test_infeasible(self):
+        x = FreshBitVec('x', 8)
+        if x == 1:
+            if x == 2:
+                self.fail('infeasible path')
+        self.prove(Or(x != 1, x != 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
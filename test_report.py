@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from z3 import *
+
+from yggdrasil import report
+from yggdrasil.util import *
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def entry(self, test, obligation, solver_time=1.0, result='unsat', path=''):
+        return dict(test=test, obligation=obligation, path=path,
+                branches=len(path), symex_time=0.5, solver_time=solver_time,
+                smt2_bytes=100, ast_nodes=10, result=result, cached=False)
+
+    def test_record(self):
+        report.record(self.entry('t.T.test_match_a', 'refinement', path='01'), self.path)
+        report.record(self.entry('t.T.test_match_a', 'refinement', path='1'), self.path)
+        records = report.load(self.path)
+        self.assertEqual([r['path'] for r in records], ['01', '1'])
+
+    def test_ast_size(self):
+        x = FreshBitVec('x', 32)
+        y = x + x
+        # x, y and the shared x + x
+        self.assertEqual(report.ast_size([y == x, y]), 3)
+        self.assertEqual(report.ast_size([True]), 1)
+
+    def test_summarize(self):
+        s = report.summarize([
+            self.entry('t.T.test_match_a', 'refinement', 1.0, path='0'),
+            self.entry('t.T.test_match_a', 'refinement', 2.0, path='1'),
+            # same obligation, checked in its own test
+            self.entry('t.T.test_match_a_crash', 'crash refinement', 3.0),
+            self.entry('t.T.test_match_a', 'crash refinement', 4.0, 'sat'),
+        ])
+        ref = s[('t.T.test_match_a', 'refinement')]
+        self.assertEqual(ref['paths'], 2)
+        self.assertEqual(ref['solver_time'], 3.0)
+        crash = s[('t.T.test_match_a', 'crash refinement')]
+        self.assertEqual(crash['paths'], 2)
+        self.assertEqual(crash['results'], ['sat', 'unsat'])
+
+    def test_rank_quantifiers(self):
+        a = self.entry('t.T.test_match_a', 'refinement')
+        a['statistics'] = {'quantifiers': {'T.equivalence@0': 10, 'k!1': 1}}
+        b = self.entry('t.T.test_match_b_crash', 'crash refinement')
+        b['statistics'] = {'quantifiers': {'T.equivalence@0': 30}}
+        ranked = report.rank_quantifiers([a, b, self.entry('t.T.test_match_c', 'refinement')])
+        total, by = ranked['T.equivalence@0']
+        self.assertEqual(total, 40)
+        self.assertEqual(by[('t.T.test_match_b', 'crash refinement')], 30)
+        self.assertEqual(ranked['k!1'][0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
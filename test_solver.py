@@ -0,0 +1,265 @@
+import os
+import time
+import signal
+import subprocess
+import unittest
+import cStringIO
+
+from z3 import *
+
+from yggdrasil import solver
+from yggdrasil import solver_utils as sutils
+from yggdrasil import test
+from yggdrasil.util import *
+
+
+class SolverPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = solver.SolverPool(size=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_reuse(self):
+        s = solver.Solver(pool=self.pool)
+        proc = s._proc
+        s.close()
+        s = solver.Solver(pool=self.pool)
+        self.assertIs(s._proc, proc)
+
+    def test_reset(self):
+        x = FreshBitVec('x', 32)
+        s = solver.Solver(pool=self.pool)
+        s.add(x == 1, x == 2)
+        self.assertEqual(s.check(), unsat)
+        s.close()
+        # The server must not remember the previous assertions
+        s = solver.Solver(pool=self.pool)
+        s.add(x == 1)
+        self.assertEqual(s.check(), sat)
+        self.assertEqual(s.model().evaluate(x), '1')
+
+    def test_evaluate_many(self):
+        x = FreshBitVec('x', 32)
+        y = FreshBitVec('y', 32)
+        z = FreshBitVec('z', 32)
+        s = solver.Solver(pool=self.pool)
+        s.add(x == 1, y == x + 1)
+        self.assertEqual(s.check(), sat)
+        m = s.model()
+        self.assertEqual(m.evaluate_many([x, y, x + y, x == y]),
+                ['1', '2', '3', 'False'])
+        self.assertEqual(evaluate_many(m, [y, 7, x]), ['2', '7', '1'])
+        # not in the model
+        self.assertEqual(len(m.evaluate_many([z, z + x])), 2)
+
+    def test_restart_crashed(self):
+        s = solver.Solver(pool=self.pool)
+        proc = s._proc
+        s.close()
+        os.kill(proc._proc.pid, signal.SIGKILL)
+        proc._proc.wait()
+        s = solver.Solver(pool=self.pool)
+        self.assertIsNot(s._proc, proc)
+        s.add(BoolVal(True))
+        self.assertEqual(s.check(), sat)
+
+    # Tests run in forked children, on the servers of their parent
+    def test_fork(self):
+        self.pool.warm()
+        proc = self.pool._idle[0]
+        pid = os.fork()
+        if pid == 0:
+            s = solver.Solver(pool=self.pool)
+            ok = s._proc is proc and s.check() == sat
+            s.close()
+            os._exit(0 if ok and self.pool._idle == [proc] else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertTrue(proc.alive())
+        s = solver.Solver(pool=self.pool)
+        self.assertIs(s._proc, proc)
+        self.assertEqual(s.check(), sat)
+
+    # A forked child lets go of a solver its parent is still using
+    def test_fork_session(self):
+        x = FreshBitVec('x', 32)
+        s = solver.Solver(pool=self.pool)
+        s.add(x == 1)
+        pid = os.fork()
+        if pid == 0:
+            proc = s._proc
+            s.close()
+            t = solver.Solver(pool=self.pool)
+            os._exit(0 if t._proc is not proc else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        s.add(x == 2)
+        self.assertEqual(s.check(), unsat)
+
+    def test_statistics(self):
+        f = Function(fresh_name('f'), IntSort(), IntSort())
+        x = Int(fresh_name('x'))
+        y = Int(fresh_name('y'))
+        with quantifier_ids('test'):
+            q = ForAll([x], f(x) == x)
+        s = solver.Solver(pool=self.pool)
+        s.set(**{solver.PROFILE: True})
+        s.add(q, f(y) == y + 1)
+        self.assertEqual(s.check(), unsat)
+        stats = s.statistics()
+        self.assertGreater(stats['quant instantiations'], 0)
+        self.assertEqual(stats['quantifiers'].keys(), ['test@0'])
+        self.assertEqual(stats['quantifiers']['test@0'], stats['quant instantiations'])
+
+    def test_size(self):
+        s1 = solver.Solver(pool=self.pool)
+        s2 = solver.Solver(pool=self.pool)
+        p2 = s2._proc
+        s1.close()
+        s2.close()
+        self.assertEqual(len(self.pool._idle), 1)
+        self.assertIsNotNone(p2._proc.poll())
+
+
+class PortfolioTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = solver.SolverPool(size=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def race(self, terms, names, **kwargs):
+        configs = [solver.CONFIGS[n] if isinstance(n, str) else n for n in names]
+        return solver.Portfolio(solver.to_smt2(*terms), {}, configs,
+                pool=self.pool, **kwargs)
+
+    def test_unsat(self):
+        x = FreshBitVec('x', 32)
+        p = self.race([x == 1, x == 2], ['default', 'no-mbqi'])
+        self.assertEqual(p.wait(), unsat)
+        self.assertIn(p.name, ['default', 'no-mbqi'])
+
+    def test_tactic(self):
+        x = FreshBitVec('x', 32)
+        y = FreshBitVec('y', 32)
+        p = self.race([x == 1, y == x + 1], ['simplify'])
+        self.assertEqual(p.wait(), sat)
+        self.assertEqual(p.name, 'simplify')
+        self.assertEqual(p.model().evaluate(y), '2')
+
+    def test_timeout(self):
+        # Factoring a 64-bit semiprime
+        x = FreshBitVec('x', 64)
+        y = FreshBitVec('y', 64)
+        n = 0xfffffffb * 0xffffffbf
+        p = self.race([ZeroExt(64, x) * ZeroExt(64, y) == n, UGT(x, 1), UGT(y, 1)],
+                ['default', 'simplify'], timeout=0.5)
+        start = time.time()
+        self.assertEqual(p.wait(), unknown)
+        self.assertIsNone(p.name)
+        self.assertLess(time.time() - start, 0.5 + solver.GRACE + 1)
+        self.assertEqual(sorted(p.times), ['default', 'simplify'])
+        # Servers that were killed are not reused
+        s = solver.Solver(pool=self.pool)
+        s.add(x == 1)
+        self.assertEqual(s.check(), sat)
+
+    def test_external(self):
+        x = FreshBitVec('x', 32)
+        p = self.race([x == 1, x == 2], [solver.Config('z3', smt='z3 -in')])
+        self.assertEqual(p.wait(), unsat)
+        self.assertIsNone(p.winner)
+
+
+class ProtocolTest(unittest.TestCase):
+    def roundtrip(self, cmd, **kwargs):
+        stream = cStringIO.StringIO()
+        sutils.write_cmd(stream, cmd, **kwargs)
+        sutils.write_cmd(stream, cmd, **kwargs)
+        stream.seek(0)
+        self.assertEqual(sutils.read_cmd(stream), cmd)
+        self.assertEqual(sutils.read_cmd(stream), cmd)
+        self.assertIsNone(sutils.read_cmd(stream))
+        return stream.getvalue()
+
+    def test_json(self):
+        data = self.roundtrip({'name': 'add', 'args': ['(assert true)'], 'kwargs': {}},
+                protocol='json')
+        self.assertTrue(data[0].isdigit())
+
+    def test_binary(self):
+        cmd = {'name': 'set', 'args': (), 'kwargs': {'AUTO_CONFIG': False}}
+        data = self.roundtrip(cmd, protocol='binary')
+        self.assertTrue(data.startswith(sutils.MAGIC))
+
+    def test_chunked(self):
+        term = '(assert "\\n")' * (3 * sutils.CHUNK_SIZE / 10)
+        cmd = {'name': 'add', 'args': (term,), 'kwargs': {}}
+        self.roundtrip(cmd, protocol='binary')
+        data = self.roundtrip(cmd, protocol='binary', compress=True)
+        self.assertLess(len(data), len(term))
+
+    def test_truncated(self):
+        stream = cStringIO.StringIO()
+        sutils.write_cmd(stream, {'return': 'x' * 100}, protocol='binary')
+        stream = cStringIO.StringIO(stream.getvalue()[:-10])
+        self.assertRaises(EOFError, sutils.read_cmd, stream)
+
+    # A client killed in the middle of a request
+    def test_server_truncated(self):
+        stream = cStringIO.StringIO()
+        sutils.write_cmd(stream, {'name': 'add', 'args': ['x' * 100], 'kwargs': {}},
+                protocol='binary')
+        p = subprocess.Popen(['python2', solver.Z3_SERVER_FILE],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        out, err = p.communicate(stream.getvalue()[:-10])
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual((out, err), ('', ''))
+
+    def test_server_json(self):
+        old = sutils.PROTOCOL
+        sutils.PROTOCOL = 'json'
+        try:
+            pool = solver.SolverPool(size=0)
+            s = solver.Solver(pool=pool)
+            x = FreshBitVec('x', 8)
+            s.add(x == 3)
+            self.assertEqual(s.check(), sat)
+            self.assertEqual(s.model().evaluate(x), '3')
+        finally:
+            sutils.PROTOCOL = old
+
+
+class Register(object):
+    def __init__(self, x):
+        self.x = x
+
+    def write(self, a, v):
+        if self.x == a:
+            self.x = v
+
+    def crash(self, mach):
+        return self.__class__(self.x)
+
+
+# The paths of an operation share the solver of their test
+class IncrementalTest(test.RefinementTest):
+    INCREMENTAL = True
+
+    def create_spec(self, mach):
+        return Register(FreshBitVec('x', 8))
+
+    def create_impl(self, mach):
+        return Register(FreshBitVec('x', 8))
+
+    def equivalence(self, spec, impl, **kwargs):
+        return spec.x == impl.x
+
+    def match_write(self):
+        yield (FreshBitVec('a', 8), FreshBitVec('v', 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
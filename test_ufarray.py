@@ -1,4 +1,5 @@
 from z3 import *
+import disk
 import unittest
 
 from yggdrasil.util import *
@@ -71,5 +72,88 @@ class ArrayTest(test.DiskTest):
         self.prove(Implies(pre, post))
 
 
+# The same, with blocks and disks backed by z3 arrays
+class ArrayBackendTest(ArrayTest):
+    ARRAYS = True
+
+    def test_backend(self):
+        self.assertIsInstance(FreshBlock('block'), ArrayBlock)
+        self.assertIsInstance(FreshDiskArray('arr')(0), ArrayBlock)
+
+    def test_ite(self):
+        arr = FreshDiskArray('arr')
+        bid = FreshSize('bid')
+        blk = ConstBlock(1)
+        on = FreshBool('on')
+        new = If(on, arr.update(bid, blk), arr)
+        self.prove(Implies(on, new(bid) == blk))
+        self.prove(Implies(Not(on), new(bid) == arr(bid)))
+
+    def test_setrange(self):
+        disk.assertion.assertions = []
+        blk = FreshBlock('block')
+        old = FreshBlock('block')
+        s = FreshString('s')
+        pre = blk == old
+        blk.setrange(1, s)
+        self.pprove(Implies(And(pre, ULT(s.size(), 4)), And(blk[0] == old[0],
+            blk[1] == If(ULT(0, s.size()), s[0], old[1]), blk[5] == old[5])))
+        blk.setrange(8, ConstString(BitVecVal(2, 64), BitVecVal(7, 64)))
+        self.pprove(Implies(And(pre, ULT(s.size(), 4)),
+            And(blk[9] == 7, blk[10] == old[10])))
+
+
+class LogTest(unittest.TestCase):
+    # Far more writes than the recursion limit
+    def test_long(self):
+        blk = FreshBlock('block')
+        off = FreshBitVec('off', BlockOffsetSort.size())
+        for i in range(5000):
+            blk[off + i] = BitVecVal(i, BlockElementSort.size())
+        self.assertEqual(simplify(blk[off + 4999]).as_long(), 4999)
+
+    def test_memo(self):
+        arr = FreshDiskArray('arr')
+        bid = FreshSize('bid')
+        off = FreshBitVec('off', BlockOffsetSort.size())
+        arr = arr.update(bid, FreshBlock('block'))
+        a = arr(bid)[off]
+        self.assertTrue(arr(bid)[off].eq(a))
+        # extends the term for the shorter log
+        arr = arr.update(bid + 1, FreshBlock('block'))
+        self.assertTrue(arr(bid)[off].arg(2).eq(a))
+
+    # Concrete keys are compared when the term is built
+    def test_concrete(self):
+        blk = FreshBlock('block')
+        x = FreshBitVec('x', 64)
+        blk[1] = x
+        blk[2] = x + 1
+        self.assertTrue(blk[1].eq(x))
+        self.assertTrue(blk[3].eq(blk._base(BitVecVal(3, BlockOffsetSort))))
+        off = FreshBitVec('off', BlockOffsetSort.size())
+        self.assertTrue(is_app_of(blk[off], Z3_OP_ITE))
+
+        arr = FreshDiskArray('arr')
+        on = FreshBool('on')
+        arr = arr.update(5, blk, on)
+        self.assertTrue(arr(5)[1].eq(If(on, x, arr._base(BitVecVal(5, 64), BitVecVal(1, BlockOffsetSort)))))
+        self.assertTrue(arr(6)[1].eq(arr._base(BitVecVal(6, 64), BitVecVal(1, BlockOffsetSort))))
+
+        f = FreshUFunction('f', SizeSort, SizeSort, SizeSort)
+        g = f.update((1, 2), x)
+        self.assertTrue(g(1, 2).eq(x))
+        self.assertTrue(g(1, 3).eq(f(1, 3)))
+        self.assertTrue(is_app_of(g(1, x), Z3_OP_ITE))
+
+    def test_snapshot(self):
+        f = FreshUFunction('f', SizeSort, SizeSort)
+        x = FreshSize('x')
+        fn = f._fn
+        g = f.update(x, BitVecVal(1, 64))
+        self.assertTrue(fn(x).eq(f(x)))
+        self.assertFalse(g(x).eq(f(x)))
+
+
 if __name__ == '__main__':
     test.main()
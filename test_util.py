@@ -0,0 +1,77 @@
+import unittest
+
+from z3 import *
+
+from yggdrasil.util import *
+
+
+class SimplifierTest(unittest.TestCase):
+    def test_conjuncts(self):
+        x = FreshBitVec('x', 8)
+        s = Simplifier()
+        out = s.conjuncts([And(x + 0 == 1, True, And(x == x, ULT(x, 3))), True])
+        self.assertEqual(len(out), 2)
+        self.assertTrue(out[0].eq(x == 1))
+
+    def test_false(self):
+        x = FreshBitVec('x', 8)
+        out = Simplifier().conjuncts([x == 1, x == x + 1, x == 2])
+        self.assertEqual(len(out), 1)
+        self.assertTrue(is_false(out[0]))
+
+    def test_memo(self):
+        x = FreshBitVec('x', 8)
+        s = Simplifier()
+        t = x + 0 == 1
+        a = s.conjuncts([t])[0]
+        b = s.conjuncts([And(t, x != 2)])[0]
+        self.assertEqual(a.get_id(), b.get_id())
+
+    # Subterms shared by different conjuncts are simplified once
+    def test_subterms(self):
+        x = FreshBitVec('x', 8)
+        b = FreshBool('b')
+        s = Simplifier()
+        t = x + 0 == 1
+        a = s.conjuncts([Implies(t, Or(b, x == 3, x == 4))])[0]
+        c = s.conjuncts([Not(If(b, t, x == 2))])[0]
+        self.assertIn(t.get_id(), s._memo)
+        self.assertTrue(a.eq(simplify(Implies(x == 1, Or(b, x == 3, x == 4)))))
+        self.assertTrue(c.eq(simplify(Not(If(b, x == 1, x == 2)))))
+
+    def test_tactic(self):
+        x = FreshBitVec('x', 8)
+        s = Simplifier('ctx-simplify')
+        out = s.conjuncts([Implies(x == 1, If(x == 1, x + 1, x) == 2)])
+        self.assertEqual(out, [])
+
+    # The whole query is the context
+    def test_tactic_context(self):
+        x = FreshBitVec('x', 8)
+        s = Simplifier('ctx-solver-simplify')
+        out = s.conjuncts([x == 1, If(x == 1, x + 1, x) == 2])
+        self.assertEqual(len(out), 1)
+        self.assertTrue(out[0].eq(x == 1))
+
+    def test_not_equivalent(self):
+        with self.assertRaises(ValueError):
+            Simplifier('solve-eqs')
+
+
+class QuantifierIdTest(unittest.TestCase):
+    def test_ids(self):
+        x = FreshBitVec('x', 8)
+        y = FreshBitVec('y', 8)
+        with quantifier_ids('t'):
+            q0 = ForAll([x], x + y != 0)
+            q1 = ForAll([x], x * y != 0, qid='mine')
+            q2 = Exists([x], x - y != 0)
+        q3 = ForAll([x], x + y != 1)
+        self.assertIn(':qid t@0', q0.sexpr())
+        self.assertIn(':qid mine', q1.sexpr())
+        self.assertIn(':qid t@1', q2.sexpr())
+        self.assertNotIn(':qid', q3.sexpr())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,16 @@
-import subprocess
+import os
 import sys
+import json
 import time
+import argparse
+import tempfile
+import unittest
+import signal
+import subprocess
+import multiprocessing as mp
 
 files = [
-    ('test_waldisk.py ', 'WAL Layer'),
+    ('test_waldisk.py', 'WAL Layer'),
     ('test_xv6inode.py', 'Inode layer'),
     ('test_dirspec.py', 'Directory layer'),
     ('test_bitmap.py', 'Bitmap disk refinement'),
@@ -11,36 +18,148 @@ files = [
     ('test_partition.py', 'Multi disk partition refinement'),
 ]
 
-n = time.time()
-
-for i, pt in files:
-    sys.stdout.write('Verifying %s.' % pt)
-    sys.stdout.flush()
-    outp = ""
-    lastp = time.time()
-    w = subprocess.Popen('python2 %s' % i, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    np = 0
-    pn = time.time()
-    while True:
-        out = w.stderr.read(1)
-        outp += out
-        if not out:
-            t = time.time() - pn
-            sys.stdout.write("%s%f seconds\n" % ('.' * (50 - np - len(pt) - len(str(int(t)))), t))
-            w.wait()
-            if w.returncode != 0:
-                print
-                print 'Failure.'
-                print outp
-                sys.exit(1)
-            break
-        if out == '.':
-            if time.time() - lastp > 1:
-                np += 1
-                sys.stdout.write(out)
+CURRENT = os.path.dirname(os.path.realpath(__file__))
+
+# Wall-clock time of each test from previous runs, used to start the
+# longest tests first.
+TIMINGS_FILE = os.path.join(CURRENT, '.verify-timings.json')
+
+
+def list_tests(filename):
+    module = __import__(os.path.splitext(filename)[0])
+    tests = []
+    suites = [unittest.defaultTestLoader.loadTestsFromModule(module)]
+    while suites:
+        for t in suites.pop():
+            if isinstance(t, unittest.TestSuite):
+                suites.append(t)
+            # Checked by another test under shared execution
+            elif not getattr(t, 'redundant', lambda: False)():
+                tests.append('%s.%s' % (t.__class__.__name__, t._testMethodName))
+    return sorted(tests)
+
+
+def load_timings():
+    try:
+        with open(TIMINGS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_timings(timings):
+    fd, tmp = tempfile.mkstemp(dir=CURRENT, prefix='.verify-timings')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    os.rename(tmp, TIMINGS_FILE)
+
+
+class Job(object):
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        self.key = '%s:%s' % (filename, name)
+
+    def start(self):
+        self.output = tempfile.TemporaryFile()
+        self.start_time = time.time()
+        self.proc = subprocess.Popen(['python2', self.filename, self.name],
+                cwd=CURRENT, stdin=open(os.devnull), stdout=self.output,
+                stderr=subprocess.STDOUT,
+                # own process group, so that kill() also gets the
+                # processes forked by symbolic execution
+                preexec_fn=os.setpgrp)
+
+    def poll(self):
+        if self.proc.poll() is None:
+            return False
+        self.time = time.time() - self.start_time
+        return True
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def read_output(self):
+        self.output.seek(0)
+        return self.output.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify Yxv6.')
+    parser.add_argument('-j', '--jobs', type=int, default=mp.cpu_count(),
+            help='number of tests to run in parallel (default: %(default)s)')
+    parser.add_argument('files', nargs='*', help='test files (default: all layers)')
+    args = parser.parse_args()
+
+    names = dict(files)
+    selected = args.files or [f for f, _ in files]
+
+    n = time.time()
+
+    jobs = []
+    for f in selected:
+        jobs += [Job(f, t) for t in list_tests(f)]
+
+    # Longest first; tests we have never timed are assumed to be long.
+    timings = load_timings()
+    jobs.sort(key=lambda j: timings.get(j.key, float('inf')), reverse=True)
+
+    print 'Verifying %d obligations from %d files with %d jobs.' % (
+            len(jobs), len(selected), args.jobs)
+
+    pending = jobs[::-1]
+    running = []
+    failed = []
+    per_file = {}
+    done = 0
+
+    try:
+        while pending or running:
+            while pending and len(running) < args.jobs:
+                job = pending.pop()
+                job.start()
+                running.append(job)
+
+            finished = [j for j in running if j.poll()]
+            if not finished:
+                time.sleep(0.05)
+                continue
+
+            for job in finished:
+                running.remove(job)
+                done += 1
+                timings[job.key] = job.time
+                per_file[job.filename] = per_file.get(job.filename, 0) + job.time
+                ok = job.proc.returncode == 0
+                if not ok:
+                    failed.append(job)
+                sys.stdout.write('[%*d/%d] %-70s %s %9.2fs\n' % (
+                    len(str(len(jobs))), done, len(jobs),
+                    '%s %s' % (job.filename, job.name),
+                    'ok  ' if ok else 'FAIL', job.time))
                 sys.stdout.flush()
-                lastp = time.time()
+    finally:
+        for job in running:
+            job.kill()
+        save_timings(timings)
+
+    print
+    for f in selected:
+        print '%-40s %12.2fs (sum of tests)' % (names.get(f, f), per_file.get(f, 0))
+
+    if failed:
+        for job in failed:
+            print
+            print 'Failure: %s %s' % (job.filename, job.name)
+            print job.read_output()
+        sys.exit(1)
+
+    print
+    print 'Success. Verified Yxv6 in %fs' % (time.time() - n)
 
 
-print
-print 'Success. Verified Yxv6 in %fs' % (time.time() - n)
+if __name__ == '__main__':
+    main()
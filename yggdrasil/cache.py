@@ -0,0 +1,145 @@
+import os
+import re
+import errno
+import hashlib
+import tempfile
+
+import z3
+
+
+# Results of proof obligations, keyed by a hash of the query.
+CACHE_DIR = os.getenv('YGGDRASIL_CACHE')
+CACHE_SIZE = int(os.getenv('YGGDRASIL_CACHE_SIZE', 64 * 1024 * 1024))
+
+# Symbols as printed by to_smt2: either quoted |...| or a run of
+# non-delimiters.
+_SYMBOL = re.compile(r'\|[^|]*\||[^\s()|";]+')
+
+# fresh_name() suffixes (name.<n>) and let-bound names (?x<n>, $x<n>,
+# a!<n>) carry counters that depend on whatever ran earlier in the
+# process.
+_COUNTER = re.compile(r'^(\|?)((?!\d).+\.|[?$]x|[a-z]!)(\d+)(\|?)$')
+
+RESULTS = ['sat', 'unsat', 'unknown']
+
+
+def _split(sym):
+    m = _COUNTER.match(sym)
+    if not m or m.group(1) != m.group(4):
+        return None
+    return (m.group(1), m.group(2)), int(m.group(3))
+
+
+# Alpha-rename counters so that the same query built in different runs
+# (or after a different set of tests) prints the same.  Within each
+# base name, counters are renumbered by rank, which keeps distinct
+# symbols distinct.
+def normalize(smt2):
+    counters = {}
+    for sym in set(_SYMBOL.findall(smt2)):
+        s = _split(sym)
+        if s:
+            counters.setdefault(s[0], set()).add(s[1])
+
+    ranks = {}
+    for base, ns in counters.items():
+        for i, n in enumerate(sorted(ns)):
+            ranks[(base, n)] = i
+
+    def rename(m):
+        sym = m.group(0)
+        s = _split(sym)
+        if not s:
+            return sym
+        (quote, name), n = s
+        return '%s%s%d%s' % (quote, name, ranks[s], quote)
+
+    return _SYMBOL.sub(rename, smt2)
+
+
+def key(smt2, options=None, backend=None):
+    h = hashlib.sha256()
+    h.update(z3.get_version_string())
+    h.update('\0')
+    h.update(repr(sorted((options or {}).items())))
+    h.update('\0')
+    h.update(backend or '')
+    h.update('\0')
+    h.update(normalize(smt2))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, path, size=CACHE_SIZE):
+        self.path = path
+        self.size = size
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                res = f.read()
+        except IOError:
+            return None
+        if res not in RESULTS:
+            return None
+        # Keep recently used entries around
+        try:
+            os.utime(self._file(key), None)
+        except OSError:
+            pass
+        return res
+
+    def put(self, key, res):
+        assert res in RESULTS
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Tests run in forked processes; rename makes the update atomic
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(res)
+        os.rename(tmp, self._file(key))
+        # Keys are uniformly distributed: scan for eviction on
+        # roughly one put in 16 rather than on every put.
+        if key.startswith('0'):
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(self._file(name))
+            except OSError:
+                continue
+            size = st.st_blocks * 512
+            entries.append((st.st_mtime, name, size))
+            total += size
+
+        entries.sort()
+        for _, name, size in entries:
+            if total <= self.size:
+                break
+            try:
+                os.unlink(self._file(name))
+            except OSError:
+                pass
+            total -= size
+
+
+_cache = None
+
+
+# The cache shared by all tests, or None if YGGDRASIL_CACHE is unset
+def default_cache():
+    global _cache
+    if _cache is None and CACHE_DIR:
+        _cache = ResultCache(CACHE_DIR)
+    return _cache
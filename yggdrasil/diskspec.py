@@ -1,10 +1,38 @@
 from z3 import *
 from util import *
 from ufarray import *
-import traceback
+import os
+import sys
+import linecache
 from collections import namedtuple
 
 
+# Remember where each control variable was created, for explain().
+CAPTURE_STACKS = os.getenv('YGGDRASIL_CAPTURE_STACKS', '1') not in ('', '0')
+
+
+# The (code, line) of each frame from the caller `depth` levels up,
+# outermost first.  This is all explain() needs, and much cheaper than
+# traceback.extract_stack(), which also looks up the source lines.
+def capture_stack(depth=0):
+    frames = []
+    f = sys._getframe(depth + 1)
+    while f is not None:
+        frames.append((f.f_code, f.f_lineno))
+        f = f.f_back
+    frames.reverse()
+    return frames
+
+
+# Same format as traceback.extract_stack()
+def resolve_stack(frames):
+    stack = []
+    for code, lineno in frames:
+        line = linecache.getline(code.co_filename, lineno).strip() or None
+        stack.append((code.co_filename, lineno, code.co_name, line))
+    return stack
+
+
 # Abstract machine model: multiple disks will share the same
 # ordering constraints.  It captures two types of constraints:
 # - a synced being true implies the current "on" being true;
@@ -23,7 +51,9 @@ class Machine(object):
     def __fresh_bool(self, name):
         b = Bool(fresh_name(name))
 
-        self._stacks[b.sexpr()] = traceback.extract_stack()[:-2]
+        # Leave out this frame and create_*
+        if CAPTURE_STACKS:
+            self._stacks[b.sexpr()] = capture_stack(2)
 
         self._control.append(b)
         if self._on is not None:
@@ -64,18 +94,54 @@ class Machine(object):
             return True
         return And(*self._ordering)
 
+    # Join two machines grown from the same one on different paths:
+    # self if cond, other otherwise.  The control variables of both
+    # are kept, each side's ordering constraints only under its cond.
+    def ite(self, other, cond):
+        def common(a, b):
+            n = 0
+            while n < min(len(a), len(b)) and a[n].eq(b[n]):
+                n += 1
+            return n
+
+        def on(m):
+            return m._on if m._on is not None else BoolVal(True)
+
+        m = Machine()
+        if self._on is not None or other._on is not None:
+            m._on = If(cond, on(self), on(other))
+        n = common(self._ordering, other._ordering)
+        m._ordering = (self._ordering[:n] +
+                [Implies(cond, c) for c in self._ordering[n:]] +
+                [Implies(Not(cond), c) for c in other._ordering[n:]])
+        for k in ['_control', '_ons', '_flushes']:
+            a, b = getattr(self, k), getattr(other, k)
+            setattr(m, k, a + b[common(a, b):])
+        m._stacks = dict(other._stacks)
+        m._stacks.update(self._stacks)
+        return m
+
+    def _stack(self, b):
+        return resolve_stack(self._stacks.get(b.sexpr(), []))
+
     def explain(self, model):
         print "<<<<<<<<<<<<<<<<<<"
 
-        print "# Outstanding writes"
-        for i in self._flushes:
-            if not model.evaluate(i).eq(BoolVal(True)):
-                print ' '.join(map(str, self._stacks[i.sexpr()][-2]))
+        values = evaluate_many(model, self._flushes + self._ons)
+        flushes = values[:len(self._flushes)]
+        ons = values[len(self._flushes):]
 
-        for i in self._ons:
-            if not model.evaluate(i).eq(BoolVal(True)):
+        print "# Outstanding writes"
+        for i, v in zip(self._flushes, flushes):
+            if v != 'True':
+                stack = self._stack(i)
+                if len(stack) >= 2:
+                    print ' '.join(map(str, stack[-2]))
+
+        for i, v in zip(self._ons, ons):
+            if v != 'True':
                 print "# Crash point"
-                for i in self._stacks[i.sexpr()]:
+                for i in self._stack(i):
                     i = ' '.join(map(str, i))
                     if '/usr/lib/' in i:
                         continue
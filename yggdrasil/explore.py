@@ -0,0 +1,403 @@
+import os
+import copy
+import types
+import itertools
+
+import z3
+
+import disk
+import util
+
+
+# Milliseconds a branch feasibility check may take; a branch that is
+# not known to be infeasible by then is explored.
+BRANCH_TIMEOUT = int(os.getenv('YGGDRASIL_BRANCH_TIMEOUT', 1000))
+
+
+class PathLimit(Exception):
+    pass
+
+
+class Unmergeable(Exception):
+    pass
+
+
+# Symbolic execution in one process: instead of forking at every branch
+# on a symbolic condition, a test is run again from the start once per
+# path.  A run follows the branches of its path (a string of '1' and
+# '0', as in DiskTest._path) and, past its end, takes a feasible side
+# of each new branch; the other side, if it is feasible too, goes on
+# the worklist.  Feasibility is checked against
+# disk.assertion.assertions, which the queries of a path include.
+class Explorer(object):
+    def __init__(self, max_depth=0, max_paths=0):
+        self.max_depth = max_depth
+        self.max_paths = max_paths
+        self.worklist = ['']
+        self.paths = 0
+        self.checks = 0
+        self.pruned = 0
+        self.path = None
+        self._results = {}
+        self._names = dict(getattr(util.fresh_name, 'idx', {}))
+
+    # Start the next path; False once all are done.
+    def next(self):
+        if not self.worklist:
+            return False
+        if self.max_paths and self.paths >= self.max_paths:
+            raise PathLimit('more than %d paths (%d left)' %
+                    (self.max_paths, len(self.worklist)))
+        self._prefix = self.worklist.pop()
+        self.path = ''
+        # The branch conditions of this run, as taken
+        self.taken = []
+        self.paths += 1
+        self._solver = None
+        self._queries = 0
+        # Every run builds the same terms for the branches they share
+        util.fresh_name.idx = dict(self._names)
+        return True
+
+    # Queries of a run are numbered.  One made while following the
+    # branches of the path was made (and passed) in the run that found
+    # the path, so its results are not checked again.
+    def replay(self):
+        self._key = (self.path, self._queries)
+        self._queries += 1
+        if len(self.path) < len(self._prefix):
+            return self._results.get(self._key)
+        return None
+
+    # Results of the query last numbered by replay()
+    def remember(self, results):
+        self._results[self._key] = results
+
+    def branch(self, cond):
+        depth = len(self.path)
+        if depth < len(self._prefix):
+            taken = self._prefix[depth] == '1'
+        else:
+            if self.max_depth and depth >= self.max_depth:
+                raise PathLimit('path longer than %d branches' % self.max_depth)
+            # The false side first, in the order of fork_bool
+            taken = not self._feasible(z3.Not(cond))
+            if taken:
+                self.pruned += 1
+            elif self._feasible(cond):
+                self.worklist.append(self.path + '1')
+            else:
+                self.pruned += 1
+        self.path += '1' if taken else '0'
+        self.taken.append(cond if taken else z3.Not(cond))
+        disk.assertion(self.taken[-1])
+        return taken
+
+    def _feasible(self, cond):
+        assertions = getattr(disk.assertion, 'assertions', [])
+        # Tests start over with a new list of assertions now and then
+        if self._solver is None or self._assertions is not assertions:
+            self._solver = z3.Solver()
+            self._solver.set(timeout=BRANCH_TIMEOUT)
+            self._assertions = assertions
+            self._added = 0
+        self._solver.add(*assertions[self._added:])
+        self._added = len(assertions)
+
+        self.checks += 1
+        self._solver.push()
+        self._solver.add(cond)
+        r = self._solver.check()
+        self._solver.pop()
+        return r != z3.unsat
+
+
+# State merging: run fn(*roots) once per path, each on the state roots
+# started in, and join the paths where fn returns.  Objects reachable
+# from roots (also through closures) end up with If-guarded values, so
+# the caller goes on with one state rather than one per path.  Raises
+# Unmergeable, with roots as they were, if two paths end in states of
+# different shapes.
+def merge(fn, *roots):
+    base = list(getattr(disk.assertion, 'assertions', []))
+    before = _reachable(roots)
+    hook = z3.BoolRef.__nonzero__
+    # As with fork_bool, every path names its terms from where the
+    # paths split, so the branch conditions of the paths cover all cases.
+    explorer = Explorer()
+    names = dict(explorer._names)
+    conds, rets, finals, added = [], [], [], []
+    try:
+        def branch(cond):
+            marks.add(len(disk.assertion.assertions))
+            return explorer.branch(cond)
+
+        z3.BoolRef.__nonzero__ = branch
+        while explorer.next():
+            _restore(before)
+            disk.assertion.assertions = list(base)
+            marks = set()
+            ret = fn(*roots)
+            conds.append(z3.And(*explorer.taken))
+            rets.append(ret)
+            finals.append(_reachable(roots + (ret,)))
+            added.append(_guarded(disk.assertion.assertions, len(base), marks))
+            for k, n in util.fresh_name.idx.items():
+                names[k] = max(names.get(k, 0), n)
+    except:
+        _restore(before)
+        raise
+    finally:
+        z3.BoolRef.__nonzero__ = hook
+        disk.assertion.assertions = base
+        # Later terms must not take the name of one of any path
+        util.fresh_name.idx = names
+
+    if len(conds) > 1:
+        join = _Join(conds, finals)
+        try:
+            # Comparing terms (say, keys of a dict) must not branch
+            z3.BoolRef.__nonzero__ = z3.AstRef.__dict__['__nonzero__']
+            rets[0] = join.run(rets)
+        except (Unmergeable, z3.Z3Exception) as e:
+            _restore(before)
+            raise Unmergeable(str(e))
+        finally:
+            z3.BoolRef.__nonzero__ = hook
+        join.commit()
+    # Paths share the assertions made before they split
+    seen = set()
+    for a in itertools.chain(*added):
+        key = a.get_id() if z3.is_expr(a) else id(a)
+        if key not in seen:
+            seen.add(key)
+            base.append(a)
+    return rets[0]
+
+
+# Assertions made on a path from start on, each under the branches the
+# path took before it (the assertions at marks).
+def _guarded(assertions, start, marks):
+    out = []
+    taken = []
+    for i in range(start, len(assertions)):
+        a = assertions[i]
+        if i in marks:
+            taken.append(a)
+        elif taken:
+            out.append(z3.Implies(z3.And(*taken), a))
+        else:
+            out.append(a)
+    return out
+
+
+_SCALARS = (int, long, float, bool, str, unicode, type(None))
+_ATOMS = (z3.AstRef, z3.Context, types.ModuleType, type, types.ClassType)
+
+
+# {id: (object, shallow copy of its state)} of the lists, dicts and
+# objects reachable from roots
+def _reachable(roots):
+    out = {}
+    seen = set()
+    todo = list(roots)
+    while todo:
+        o = todo.pop()
+        if id(o) in seen or isinstance(o, _SCALARS + _ATOMS):
+            continue
+        seen.add(id(o))
+        if isinstance(o, list):
+            out[id(o)] = o, list(o)
+            todo.extend(o)
+        elif isinstance(o, dict):
+            out[id(o)] = o, dict(o)
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, tuple):
+            todo.extend(o)
+        elif isinstance(o, types.FunctionType):
+            todo.extend(o.func_defaults or ())
+            for cell in o.func_closure or ():
+                try:
+                    todo.append(cell.cell_contents)
+                except ValueError:
+                    pass
+        elif isinstance(o, types.MethodType):
+            todo.append(o.im_self)
+        elif hasattr(o, '__dict__'):
+            out[id(o)] = o, dict(o.__dict__)
+            todo.extend(o.__dict__.values())
+        elif type(o).__module__ != '__builtin__':
+            # Such as extension types, whose state cannot be saved
+            raise Unmergeable('cannot save the state of %s' % type(o))
+    return out
+
+
+def _set_state(o, state):
+    if isinstance(o, list):
+        o[:] = state
+    elif isinstance(o, dict):
+        o.clear()
+        o.update(state)
+    else:
+        o.__dict__.clear()
+        o.__dict__.update(state)
+
+
+def _restore(states):
+    for o, state in states.values():
+        _set_state(o, state)
+
+
+def _same(a, b):
+    if isinstance(a, list):
+        return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+    return len(a) == len(b) and all(b.get(k, a) is x for k, x in a.items())
+
+
+# Join the states of several paths: finals[i] is the state path i ended
+# in, under conds[i] (the last one is the default).  Objects of every
+# path are joined in place; objects a path made are joined into new ones.
+class _Join(object):
+    def __init__(self, conds, finals):
+        self._conds = conds
+        self._finals = finals
+        self._memo = {}
+        self._pending = []
+        self._owned = set()
+
+    def run(self, rets):
+        common = [(o, [f[k][1] for f in self._finals])
+                for k, (o, _) in self._finals[0].items()
+                if all(f.get(k, (None,))[0] is o for f in self._finals[1:])]
+        # ufarray objects and Machine join the lists and dicts they hold
+        for o, states in common:
+            if self._joins_itself(o):
+                for state in states:
+                    self._owned.update(id(v) for v in state.values()
+                            if isinstance(v, (list, dict)))
+        for o, states in common:
+            if id(o) not in self._owned:
+                self._join_state(o, states)
+        return self.join(rets)
+
+    # Write the joined state into the objects of every path
+    def commit(self):
+        for o, state in self._pending:
+            _set_state(o, state)
+
+    def join(self, values):
+        key = tuple(map(id, values))
+        if key in self._memo:
+            return self._memo[key]
+        out = self._join(values, key)
+        self._memo[key] = out
+        return out
+
+    def _joins_itself(self, o):
+        return hasattr(o, 'ite') and not isinstance(o, (list, dict))
+
+    def _ite(self, values):
+        out = values[-1]
+        try:
+            for c, v in reversed(zip(self._conds, values[:-1])):
+                out = util.If(c, v, out)
+        except z3.Z3Exception as e:
+            raise Unmergeable(str(e))
+        return out
+
+    # Object v in the state path i ended in
+    def _view(self, v, i):
+        entry = self._finals[i].get(id(v))
+        if entry is None:
+            return v
+        state = entry[1]
+        if isinstance(v, list):
+            return list(state)
+        if isinstance(v, dict):
+            return dict(state)
+        view = copy.copy(v)
+        _set_state(view, state)
+        for k, x in state.items():
+            if isinstance(x, (list, dict)):
+                view.__dict__[k] = self._view(x, i)
+        return view
+
+    def _unchanged(self, o, states):
+        if not all(_same(states[0], s) for s in states[1:]):
+            return False
+        if not self._joins_itself(o):
+            return True
+        for v in states[0].values():
+            if id(v) in self._owned:
+                inner = [f[id(v)][1] for f in self._finals]
+                if not all(_same(inner[0], s) for s in inner[1:]):
+                    return False
+        return True
+
+    def _join_state(self, o, states):
+        if self._unchanged(o, states):
+            return
+        first = states[0]
+        if isinstance(o, list):
+            if any(len(s) != len(first) for s in states):
+                raise Unmergeable('lists of different lengths')
+            state = [self.join(vs) for vs in zip(*states)]
+        elif self._joins_itself(o):
+            views = [self._view(o, i) for i in range(len(states))]
+            state = self._ite(views).__dict__
+        else:
+            if any(set(s) != set(first) for s in states):
+                raise Unmergeable('%s with different fields' % type(o))
+            state = dict((k, self.join([s[k] for s in states])) for k in first)
+        self._pending.append((o, state))
+
+    def _join(self, values, key):
+        first = values[0]
+        # Objects of every path are joined by run()
+        if all(v is first for v in values[1:]):
+            return first
+        if isinstance(first, _SCALARS):
+            if all(type(v) is type(first) and v == first for v in values[1:]):
+                return first
+            raise Unmergeable('%r and %r' % (first, values[1]))
+        if z3.is_expr(first):
+            if all(z3.is_expr(v) and first.eq(v) for v in values[1:]):
+                return first
+            return self._ite(values)
+        if any(type(v) is not type(first) for v in values[1:]):
+            raise Unmergeable('%s and %s' % (type(first), type(values[1])))
+        if isinstance(first, tuple):
+            if any(len(v) != len(first) for v in values):
+                raise Unmergeable('tuples of different lengths')
+            return tuple(self.join(vs) for vs in zip(*values))
+
+        # Code cannot be If-guarded; objects that hold it, such as
+        # ufarray's, join themselves with ite().
+        if isinstance(first, (types.FunctionType, types.MethodType)):
+            raise Unmergeable('different functions %s and %s' % (first, values[1]))
+
+        views = [self._view(v, i) for i, v in enumerate(values)]
+        if isinstance(first, list):
+            if any(len(v) != len(first) for v in views):
+                raise Unmergeable('lists of different lengths')
+            out = self._memo[key] = []
+            out.extend(self.join(vs) for vs in zip(*views))
+            return out
+        if isinstance(first, dict):
+            if any(set(v) != set(views[0]) for v in views):
+                raise Unmergeable('dicts with different keys')
+            out = self._memo[key] = {}
+            out.update((k, self.join([v[k] for v in views])) for k in views[0])
+            return out
+        if not hasattr(first, '__dict__'):
+            raise Unmergeable('cannot join %s' % type(first))
+        if self._joins_itself(first):
+            return self._ite(views)
+        fields = [v.__dict__ for v in views]
+        if any(set(f) != set(fields[0]) for f in fields):
+            raise Unmergeable('%s objects with different fields' % type(first))
+        out = self._memo[key] = copy.copy(first)
+        out.__dict__.update((k, self.join([f[k] for f in fields]))
+                for k in fields[0])
+        return out
@@ -0,0 +1,186 @@
+import os
+import re
+import sys
+import json
+import argparse
+
+import z3
+
+
+# Append one JSON line per proof obligation (and per path) to this file
+REPORT = os.getenv('YGGDRASIL_REPORT')
+
+
+# Tests run in forked processes that all append to the same file; one
+# write() of a line opened with O_APPEND is not interleaved with others.
+def record(fields, filename=None):
+    if filename is None:
+        filename = REPORT
+    if not filename:
+        return
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+# Number of distinct AST nodes (as a DAG) of a list of terms
+def ast_size(terms):
+    seen = set()
+    # Python bools are fine in a query, too
+    todo = [z3.BoolVal(t) if isinstance(t, bool) else t for t in terms]
+    while todo:
+        t = todo.pop()
+        i = t.get_id()
+        if i in seen:
+            continue
+        seen.add(i)
+        if z3.is_quantifier(t):
+            todo.append(t.body())
+        elif z3.is_app(t):
+            todo.extend(t.children())
+    return len(seen)
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+# test_match_X_crash and test_match_X_pre check obligations of
+# test_match_X, and do so in test_match_X with shared execution.
+_SPLIT_TEST = re.compile(r'_(crash|pre)$')
+
+
+# Sum up the paths of each obligation
+def summarize(records):
+    out = {}
+    for r in records:
+        k = (_SPLIT_TEST.sub('', r['test']), r['obligation'])
+        s = out.setdefault(k, {'paths': 0, 'symex_time': 0.0,
+            'solver_time': 0.0, 'smt2_bytes': 0, 'ast_nodes': 0,
+            'raw_ast_nodes': 0, 'instantiations': 0, 'conflicts': 0, 'results': []})
+        s['paths'] += 1
+        s['symex_time'] += r['symex_time']
+        s['solver_time'] += r['solver_time']
+        s['smt2_bytes'] = max(s['smt2_bytes'], r['smt2_bytes'])
+        s['ast_nodes'] = max(s['ast_nodes'], r['ast_nodes'])
+        # Before YGGDRASIL_SIMPLIFY
+        s['raw_ast_nodes'] = max(s['raw_ast_nodes'], r.get('raw_ast_nodes', r['ast_nodes']))
+        stats = r.get('statistics') or {}
+        s['instantiations'] += stats.get('quant instantiations', 0)
+        s['conflicts'] += stats.get('conflicts', 0)
+        if r['result'] not in s['results']:
+            s['results'].append(r['result'])
+    for s in out.values():
+        s['results'].sort()
+    return out
+
+
+def _name(k):
+    return '%s [%s]' % k
+
+
+def show(args):
+    summary = summarize(load(args.report))
+    print '%-80s %6s %10s %10s %10s %9s %7s %10s %9s  %s' % ('obligation',
+            'paths', 'symex (s)', 'solver (s)', 'smt2 (B)', 'nodes', 'shrink',
+            'qi', 'conflicts', 'results')
+    for k, s in sorted(summary.items(), key=lambda kv: -kv[1]['solver_time']):
+        shrink = 1 - float(s['ast_nodes']) / (s['raw_ast_nodes'] or 1)
+        print '%-80s %6d %10.2f %10.2f %10d %9d %6.1f%% %10d %9d  %s' % (_name(k),
+                s['paths'], s['symex_time'], s['solver_time'], s['smt2_bytes'],
+                s['ast_nodes'], 100 * shrink, s['instantiations'],
+                s['conflicts'], ','.join(s['results']))
+
+
+# Instantiations of each quantifier (by qid) over all obligations:
+# {qid: (total, {(test, obligation): count})}
+def rank_quantifiers(records):
+    out = {}
+    for r in records:
+        stats = r.get('statistics') or {}
+        k = (_SPLIT_TEST.sub('', r['test']), r['obligation'])
+        for qid, n in stats.get('quantifiers', {}).items():
+            total, by = out.get(qid, (0, {}))
+            by[k] = by.get(k, 0) + n
+            out[qid] = (total + n, by)
+    return out
+
+
+def quantifiers(args):
+    ranked = rank_quantifiers(load(args.report))
+    grand = sum(total for total, _ in ranked.values()) or 1
+    print '%-50s %12s %6s  %s' % ('quantifier', 'instances', '%', 'most in')
+    for qid, (total, by) in sorted(ranked.items(), key=lambda kv: -kv[1][0])[:args.top]:
+        k, n = max(by.items(), key=lambda kv: kv[1])
+        print '%-50s %12d %6.1f  %s (%d)' % (qid, total, 100.0 * total / grand,
+                _name(k), n)
+
+
+# Flag obligations that got slower, bigger, or changed their results
+def diff(args):
+    old = summarize(load(args.old))
+    new = summarize(load(args.new))
+
+    regressions = []
+    for k in sorted(set(old) | set(new)):
+        if k not in new:
+            print 'removed   %s' % _name(k)
+            continue
+        if k not in old:
+            print 'added     %s' % _name(k)
+            continue
+        o, n = old[k], new[k]
+        why = []
+        if o['results'] != n['results']:
+            why.append('results %s -> %s' % (','.join(o['results']), ','.join(n['results'])))
+        if o['paths'] != n['paths']:
+            why.append('paths %d -> %d' % (o['paths'], n['paths']))
+        for f in ['solver_time', 'symex_time']:
+            if (n[f] - o[f] > args.min_time and
+                    n[f] > o[f] * args.threshold):
+                why.append('%s %.2fs -> %.2fs' % (f, o[f], n[f]))
+        for f in ['smt2_bytes', 'ast_nodes', 'instantiations']:
+            if n[f] > o[f] * args.threshold:
+                why.append('%s %d -> %d' % (f, o[f], n[f]))
+        if why:
+            regressions.append(k)
+            print 'REGRESSED %s: %s' % (_name(k), '; '.join(why))
+
+    print
+    print '%d obligations, %d regressed' % (len(new), len(regressions))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Proof obligation reports (YGGDRASIL_REPORT).')
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser('show', help='summarize a report')
+    p.add_argument('report')
+    p.set_defaults(fn=show)
+
+    p = sub.add_parser('quantifiers', help='rank quantifiers by instantiations')
+    p.add_argument('report')
+    p.add_argument('--top', type=int, default=20,
+            help='show this many quantifiers (default: %(default)s)')
+    p.set_defaults(fn=quantifiers)
+
+    p = sub.add_parser('diff', help='compare two reports')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=1.5,
+            help='flag increases by more than this factor (default: %(default)s)')
+    p.add_argument('--min-time', type=float, default=1.0,
+            help='ignore time increases below this many seconds (default: %(default)s)')
+    p.set_defaults(fn=diff)
+
+    args = parser.parse_args()
+    sys.exit(args.fn(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,43 @@
+import os
+import re
 import sys
+import resource
+import tempfile
 import util
 import z3
 
-from solver_utils import write_cmd, read_cmd
+from solver_utils import write_cmd, read_frame, FLAG_ZLIB
+
+
+# With smt.qi.profile, z3 prints a line per quantifier on stderr
+# after each check: qid, instances, max generation, max cost, ...
+QI_PROFILE = re.compile(r'^\[quantifier_instances\]\s+(\S+)\s+:\s+(\d+)\s+:')
 
 
 class Server(object):
     def __init__(self):
-        self._s = z3.Solver()
-
+        self._ctx = z3.Context()
+        self._s = z3.Solver(ctx=self._ctx)
+        self._protocol = None
+        self._compress = False
+        self._quantifiers = {}
+        self._stderr = tempfile.TemporaryFile()
+        self._model = None
+
+    # Replies use the same framing as the last request
     def _write(self, command):
-        return write_cmd(sys.stdout, command)
+        return write_cmd(sys.stdout, command,
+                protocol=self._protocol, compress=self._compress)
 
     def _read(self):
-        return read_cmd(sys.stdin)
+        try:
+            protocol, flags, cmd = read_frame(sys.stdin)
+        except EOFError:
+            # The client went away in the middle of a request
+            return None
+        self._protocol = protocol
+        self._compress = bool(flags & FLAG_ZLIB)
+        return cmd
 
     def run(self):
         while True:
@@ -28,14 +52,78 @@ class Server(object):
         except Exception, e:
             self._write({'exc': repr(e)})
 
+    # Start over with a fresh solver; the token is echoed back so that
+    # the client can resynchronize with the server.  A new context, too:
+    # terms left over from earlier queries change how z3 searches, and
+    # a query should take as long on a used server as on a new one.
+    def reset(self, token=None):
+        self._model = None
+        self._ctx = z3.Context()
+        self._s = z3.Solver(ctx=self._ctx)
+        self._quantifiers = {}
+        self.limit(None)
+        return token
+
+    # Replace the solver with one built from a tactic pipeline, e.g.,
+    # tactic('simplify', 'solve-eqs', 'smt').
+    def tactic(self, *names):
+        if len(names) == 1:
+            self._s = z3.Tactic(names[0], ctx=self._ctx).solver()
+        else:
+            self._s = z3.Then(*names, ctx=self._ctx).solver()
+
+    # Cap the address space of the server (in MiB); z3 fails to
+    # allocate rather than pushing the machine into swap.
+    def limit(self, memory=None):
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        soft = hard
+        if memory is not None:
+            soft = memory * 1024 * 1024
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
     def add(self, term):
-        self._s.add(z3.parse_smt2_string(term))
+        self._s.add(z3.parse_smt2_string(term, ctx=self._ctx))
 
     def set(self, **kwargs):
         self._s.set(**{str(k): v for k, v in kwargs.items()})
 
     def check(self):
-        return str(self._s.check())
+        self._model = None
+        self._stderr.seek(0)
+        self._stderr.truncate()
+        saved = os.dup(2)
+        os.dup2(self._stderr.fileno(), 2)
+        try:
+            return str(self._s.check())
+        finally:
+            os.dup2(saved, 2)
+            os.close(saved)
+            self._quantifiers = self._profile()
+
+    # Instantiations per qid from the profile of the last check; the
+    # rest of what z3 printed goes on to our stderr.
+    def _profile(self):
+        quantifiers = {}
+        self._stderr.seek(0)
+        for line in self._stderr:
+            m = QI_PROFILE.match(line)
+            if m:
+                qid = m.group(1)
+                quantifiers[qid] = quantifiers.get(qid, 0) + int(m.group(2))
+            else:
+                sys.stderr.write(line)
+        return quantifiers
+
+    # Statistics of the last check, plus 'quantifiers': the number of
+    # instantiations of each quantifier (by qid) if smt.qi.profile is
+    # set.
+    def statistics(self):
+        st = self._s.statistics()
+        stats = dict((k, st.get_key_value(k)) for k in st.keys())
+        stats['quantifiers'] = self._quantifiers
+        return stats
 
     def push(self):
         return str(self._s.push())
@@ -46,14 +134,34 @@ class Server(object):
     def model(self):
         return str(self._s.model())
 
-    def model_evaluate(self, term):
-        model = self._s.model()
+    # The model of the last check, and its declarations by name
+    def _model_decls(self):
+        if self._model is None:
+            model = self._s.model()
+            self._model = model, dict((str(d), d) for d in model.decls())
+        return self._model
 
-        for t in model.decls():
-            if str(t) == term:
-                term = t()
-                break
-        return str(self._s.model().evaluate(term))
+    def model_evaluate(self, term):
+        return self.evaluate_many([term])[0]
+
+    # Evaluate a list of terms (as s-expressions) in the model at once
+    def evaluate_many(self, terms):
+        model, decls = self._model_decls()
+        out = []
+        for term in terms:
+            d = decls.get(term)
+            if d is not None and d.arity() == 0:
+                out.append(str(model.evaluate(d())))
+                continue
+            try:
+                t = z3.parse_smt2_string('(assert (= %s %s))' % (term, term),
+                        decls=decls, ctx=self._ctx)[0].arg(0)
+            except z3.Z3Exception:
+                # Mentions symbols the model does not constrain
+                out.append(term)
+                continue
+            out.append(str(model.evaluate(t)))
+        return out
 
 
 if __name__ == '__main__':
@@ -1,4 +1,10 @@
+import atexit
+import itertools
+import resource
+import select
 import subprocess
+import tempfile
+import time
 import os
 
 import util
@@ -9,6 +15,29 @@ import solver_utils as sutils
 CURRENT = os.path.dirname(os.path.realpath(__file__))
 Z3_SERVER_FILE = os.path.join(CURRENT, "server.py")
 
+# Number of idle solver servers kept around between queries.
+POOL_SIZE = int(os.getenv('YGGDRASIL_POOL_SIZE', 2))
+
+# Seconds an idle server has to answer a health check.
+HEALTH_TIMEOUT = 10
+
+RESULTS = {'sat': z3.sat, 'unsat': z3.unsat, 'unknown': z3.unknown}
+
+# Count instantiations per quantifier (see Solver.statistics)
+PROFILE = 'smt.qi.profile'
+
+# Portfolio solving: a comma-separated list of CONFIGS (below) to race
+# on every query, e.g., YGGDRASIL_PORTFOLIO=default,no-mbqi,simplify.
+PORTFOLIO = [n for n in os.getenv('YGGDRASIL_PORTFOLIO', '').split(',') if n]
+
+# Wall-clock limit (seconds) and memory cap (MiB) of each attempt
+TIMEOUT = float(os.getenv('YGGDRASIL_TIMEOUT', 0)) or None
+MEMORY = int(os.getenv('YGGDRASIL_MEMORY', 0)) or None
+
+# Seconds a solver gets past TIMEOUT to give up by itself before it is
+# killed.
+GRACE = 1
+
 
 def to_smt2(*terms):
     s = z3.Solver()
@@ -31,46 +60,239 @@ class ModelProxy(object):
         term = term.sexpr()
         return self._solver._call('model_evaluate', term)
 
+    # One round trip for all terms
+    def evaluate_many(self, terms):
+        return self._solver._call('evaluate_many', [t.sexpr() for t in terms])
+
     def eval(self, term):
         return self.evaluate(term)
 
 
-class Solver(object):
+# A long-lived `python2 server.py` process.
+class SolverProcess(object):
+    _tokens = itertools.count()
+
     def __init__(self):
+        # close_fds: a server must not hold on to the pipes of its
+        # siblings, otherwise they never see EOF on shutdown.
         self._proc = subprocess.Popen(['python2', Z3_SERVER_FILE],
                 stdout=subprocess.PIPE,
                 stdin=subprocess.PIPE,
+                close_fds=True,
                 # stderr=subprocess.PIPE
                 )
+        self._owner = os.getpid()
 
-    def _write(self, command):
+    def write(self, command):
         sutils.write_cmd(self._proc.stdin, command)
 
-    def _call(self, name, *args, **kwargs):
-        self._write({'name': name, 'args': args, 'kwargs': kwargs})
-        res = self._read()
+    def read(self):
+        try:
+            return sutils.read_cmd(self._proc.stdout)
+        except EOFError:
+            return None
+
+    def call(self, name, *args, **kwargs):
+        self.send(name, *args, **kwargs)
+        return self.receive()
+
+    # send/receive split a call, so that several servers can work
+    # at the same time.
+    def send(self, name, *args, **kwargs):
+        self.write({'name': name, 'args': args, 'kwargs': kwargs})
+
+    def receive(self):
+        res = self.read()
+        if res is None:
+            raise RuntimeError("solver server exited")
         if 'return' in res:
             return res['return']
         if 'exc' in res:
             raise RuntimeError(res['exc'])
 
-    def _read(self, **kwargs):
-        return sutils.read_cmd(self._proc.stdout)
+    # Only the process that started a server can wait for it: in a
+    # forked child, waitpid() fails with ECHILD, which Popen.poll()
+    # takes for an exit.
+    def owned(self):
+        return os.getpid() == self._owner
+
+    def alive(self):
+        if self.owned():
+            return self._proc.poll() is None
+        try:
+            os.kill(self._proc.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def fileno(self):
+        return self._proc.stdout.fileno()
+
+    # Health check: drop all server state and wait for the reply.
+    # Replies left in the pipe by an interrupted user (e.g., a forked
+    # child killed in the middle of a query) are skipped until our
+    # token comes back.
+    def reset(self, timeout=HEALTH_TIMEOUT):
+        token = '%d.%d' % (os.getpid(), next(self._tokens))
+        try:
+            self.write({'name': 'reset', 'args': [token], 'kwargs': {}})
+            while True:
+                ready, _, _ = select.select([self._proc.stdout], [], [], timeout)
+                if not ready:
+                    return False
+                res = self.read()
+                if res is None:
+                    return False
+                if res.get('return') == token:
+                    return True
+        except (IOError, OSError, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            pass
+        self._wait()
+
+    # A forked child may stop a server it inherited in the middle of a
+    # check (say, past TIMEOUT); its owner reaps it.
+    def kill(self):
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self._wait()
+
+    def _wait(self):
+        if self.owned():
+            self._proc.wait()
+
+
+# Pool of solver servers, so that each query does not pay for
+# starting python and importing z3.
+class SolverPool(object):
+    def __init__(self, size=None):
+        if size is None:
+            size = POOL_SIZE
+        self.size = size
+        self._idle = []
+        atexit.register(self.shutdown)
+
+    # Servers a forked child inherited stay with their owner, which
+    # goes on using them once the child is done: the child drops the
+    # ones it cannot use rather than kill them.
+    def acquire(self):
+        while self._idle:
+            proc = self._idle.pop()
+            if proc.alive() and proc.reset():
+                return proc
+            # crashed or wedged; replace it
+            if proc.owned():
+                proc.kill()
+        return SolverProcess()
+
+    def release(self, proc):
+        if proc.alive() and len(self._idle) < self.size:
+            self._idle.append(proc)
+        elif proc.owned():
+            proc.kill()
+
+    # Start servers ahead of time, e.g., before forking test processes
+    # so that all of them share the same servers.
+    def warm(self):
+        while len(self._idle) < self.size:
+            self._idle.append(SolverProcess())
+
+    def shutdown(self):
+        # Forked children share the servers of their parent; each
+        # process reaps the ones it started.
+        for proc in self._idle:
+            if proc.owned():
+                proc.close()
+        self._idle = [proc for proc in self._idle if not proc.owned()]
+
+
+_pool = None
+
+
+def default_pool():
+    global _pool
+    if _pool is None:
+        _pool = SolverPool()
+    return _pool
+
+
+class Solver(object):
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = default_pool()
+        self._pool = pool
+        self._pid = os.getpid()
+        self._proc = pool.acquire()
+
+    def __del__(self):
+        self.close()
+
+    # Give the server back to the pool.  Models returned by `model`
+    # keep the solver (and hence the server) alive.  A forked child
+    # leaves it to its parent, which may still be using it (e.g., an
+    # incremental session forked at a branch).
+    def close(self):
+        if getattr(self, '_proc', None) is not None:
+            if os.getpid() == self._pid:
+                self._pool.release(self._proc)
+            self._proc = None
+
+    def _call(self, name, *args, **kwargs):
+        return self._proc.call(name, *args, **kwargs)
 
     def add(self, *terms):
-        term = to_smt2(*terms)
-        return self._call('add', term)
+        return self.add_smt2(to_smt2(*terms))
+
+    def add_smt2(self, smt2):
+        return self._call('add', smt2)
 
     def set(self, *args, **kwargs):
         return self._call('set', *args, **kwargs)
 
+    # Solve with a tactic pipeline; must come before add().
+    def tactic(self, *names):
+        return self._call('tactic', *names)
+
+    # Cap the memory of the server (MiB) until it goes back to the pool
+    def limit(self, memory):
+        return self._call('limit', memory)
+
+    # Stop a server in the middle of a check; it is not reused.
+    def kill(self):
+        if getattr(self, '_proc', None) is not None:
+            self._proc.kill()
+            self._proc = None
+
     def check(self):
-        vals = {'sat': z3.sat, 'unsat': z3.unsat, 'unknown': z3.unknown}
-        return vals.get(self._call('check'))
+        self.check_async()
+        return self.wait()
+
+    # Start a check without waiting for its result
+    def check_async(self):
+        self._proc.send('check')
+
+    def wait(self):
+        return RESULTS.get(self._proc.receive())
+
+    # For select(): readable once the result of check_async is in
+    def fileno(self):
+        return self._proc.fileno()
 
     def model(self):
         return ModelProxy(self._call('model'), self)
 
+    # Statistics of the last check as a dict, including 'quantifiers':
+    # instantiations per qid when PROFILE is set.
+    def statistics(self):
+        return self._call('statistics')
+
     def push(self):
         return self._call('push')
 
@@ -78,6 +300,148 @@ class Solver(object):
         return self._call('pop')
 
 
+# An external solver (`SMT`) reading the query on stdin
+class ExternalSolver(object):
+    def __init__(self, cmd, smt2, options=None, memory=None):
+        args = ["{}={}".format(a, str(b).lower()) for a, b in (options or {}).items()]
+        query = tempfile.TemporaryFile()
+        query.write(smt2)
+        query.seek(0)
+
+        def preexec():
+            if memory is not None:
+                size = memory * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (size, size))
+
+        self._proc = subprocess.Popen(cmd.split() + args,
+                stdin=query,
+                stdout=subprocess.PIPE,
+                stderr=open(os.devnull, 'w'),
+                close_fds=True,
+                preexec_fn=preexec)
+
+    def fileno(self):
+        return self._proc.stdout.fileno()
+
+    def wait(self):
+        out = self._proc.stdout.read().strip()
+        self._proc.wait()
+        return RESULTS.get(out, z3.unknown)
+
+    def kill(self):
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self._proc.wait()
+
+    def close(self):
+        pass
+
+
+# A way of solving a query: solver options (on top of those of the
+# query), a tactic pipeline, or an external solver command.
+class Config(object):
+    def __init__(self, name, options=None, tactic=None, smt=None):
+        self.name = name
+        self.options = options or {}
+        self.tactic = tactic
+        self.smt = smt
+
+    def start(self, smt2, options, timeout=None, memory=None, pool=None,
+            profile=False):
+        options = dict(options or {})
+        options.update(self.options)
+
+        if self.smt:
+            return ExternalSolver(self.smt, smt2, options, memory)
+
+        if profile:
+            options[PROFILE] = True
+        if timeout is not None:
+            options['timeout'] = int(timeout * 1000)
+        if memory is not None:
+            # Let z3 give up by itself before hitting the rlimit
+            options['max_memory'] = memory
+        s = Solver(pool=pool)
+        if self.tactic:
+            s.tactic(*self.tactic)
+        if memory is not None:
+            s.limit(memory)
+        s.set(**options)
+        s.add_smt2(smt2)
+        s.check_async()
+        return s
+
+
+CONFIGS = dict((c.name, c) for c in [
+    Config('default'),
+    Config('auto-config', {'AUTO_CONFIG': True}),
+    Config('no-auto-config', {'AUTO_CONFIG': False}),
+    Config('mbqi', {'AUTO_CONFIG': False, 'MBQI': True}),
+    Config('no-mbqi', {'AUTO_CONFIG': False, 'MBQI': False}),
+    Config('simplify', tactic=['simplify', 'propagate-values', 'solve-eqs', 'smt']),
+])
+
+
+# Race several configurations on one query, each on its own server,
+# and take the first sat or unsat.  Attempts that are still running
+# then are killed.
+class Portfolio(object):
+    def __init__(self, smt2, options=None, configs=None, timeout=TIMEOUT,
+            memory=MEMORY, pool=None, profile=False):
+        if configs is None:
+            configs = [CONFIGS[n] for n in PORTFOLIO]
+        self.timeout = timeout
+        # The winning Solver (None for an external solver) and its name
+        self.winner = None
+        self.name = None
+        # Seconds each configuration ran, until it answered or was stopped
+        self.times = {}
+        self._start = time.time()
+        self._attempts = [(c, c.start(smt2, options, timeout, memory, pool, profile))
+                          for c in configs]
+
+    def wait(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = self._start + self.timeout + GRACE
+
+        pending = dict((s, c) for c, s in self._attempts)
+        result = z3.unknown
+        while pending and self.name is None:
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            ready, _, _ = select.select(pending.keys(), [], [], wait)
+            if not ready:
+                break
+            for s in ready:
+                c = pending.pop(s)
+                self.times[c.name] = time.time() - self._start
+                try:
+                    r = s.wait()
+                except RuntimeError:
+                    # e.g., the server ran out of memory
+                    r = None
+                if r is None:
+                    s.kill()
+                elif r == z3.unknown or self.name is not None:
+                    s.close()
+                else:
+                    result = r
+                    self.winner = None if c.smt else s
+                    self.name = c.name
+
+        for s, c in pending.items():
+            self.times[c.name] = time.time() - self._start
+            s.kill()
+        return result
+
+    def model(self):
+        return self.winner.model()
+
+
 if __name__ == '__main__':
     x = util.FreshBitVec('x', 32)
     y = util.FreshBitVec('y', 32)
@@ -1,14 +1,65 @@
 import math
 import json
+import marshal
+import os
+import struct
+import zlib
 
+# JSON framing: an 8-digit ASCII length followed by a JSON document.
 LEN_LEN = 8
 
-def write_cmd(stream, command):
+# Binary framing: MAGIC, a flags byte, then the marshalled command as a
+# stream of chunks, each prefixed with its 4-byte big-endian length.
+# A zero-length chunk ends the frame.  MAGIC never starts with a digit,
+# so a reader can tell both framings apart from the first byte.
+MAGIC = '\xffYG'
+FLAG_ZLIB = 1
+CHUNK_LEN = struct.Struct('>I')
+CHUNK_SIZE = 1 << 20
+
+PROTOCOL = os.getenv('YGGDRASIL_PROTOCOL', 'binary')
+COMPRESS = os.getenv('YGGDRASIL_COMPRESS', '0') not in ('', '0')
+COMPRESS_LEVEL = 1
+
+
+def write_cmd(stream, command, protocol=None, compress=None):
+    if protocol is None:
+        protocol = PROTOCOL
+    if compress is None:
+        compress = COMPRESS
+    if protocol == 'json':
+        write_json(stream, command)
+    else:
+        write_binary(stream, command, compress)
+    stream.flush()
+
+
+def write_json(stream, command):
     payload = json.dumps(command)
     assert math.log(len(payload), 10) < LEN_LEN, "payload length = {} to large".format(len(payload))
     stream.write(str(len(payload)).rjust(LEN_LEN, '0'))
     stream.write(payload)
-    stream.flush()
+
+
+def write_binary(stream, command, compress=False):
+    payload = marshal.dumps(command)
+    stream.write(MAGIC + chr(FLAG_ZLIB if compress else 0))
+    z = zlib.compressobj(COMPRESS_LEVEL) if compress else None
+    for off in xrange(0, len(payload), CHUNK_SIZE):
+        chunk = buffer(payload, off, CHUNK_SIZE)
+        if z:
+            chunk = z.compress(chunk)
+        write_chunk(stream, chunk)
+    if z:
+        write_chunk(stream, z.flush())
+    stream.write(CHUNK_LEN.pack(0))
+
+
+def write_chunk(stream, chunk):
+    # An empty chunk would end the frame
+    if len(chunk):
+        stream.write(CHUNK_LEN.pack(len(chunk)))
+        stream.write(chunk)
 
 
 def read(stream, count):
@@ -16,10 +67,33 @@ def read(stream, count):
     return v
 
 
+def read_exact(stream, count):
+    v = read(stream, count)
+    if len(v) != count:
+        raise EOFError("truncated frame")
+    return v
+
+
 def read_cmd(stream):
-    cmdlen = read(stream, LEN_LEN)
-    if not cmdlen:
-        return None
+    return read_frame(stream)[2]
+
+
+# Returns (protocol, flags, command) so that a server can reply in
+# the same framing as the request.
+def read_frame(stream):
+    head = read(stream, 1)
+    if not head:
+        return None, 0, None
+    if head == MAGIC[0]:
+        if read_exact(stream, len(MAGIC) - 1) != MAGIC[1:]:
+            raise ValueError("bad frame magic")
+        flags = ord(read_exact(stream, 1))
+        return 'binary', flags, read_binary(stream, flags)
+    return 'json', 0, read_json(stream, head)
+
+
+def read_json(stream, head=''):
+    cmdlen = head + read_exact(stream, LEN_LEN - len(head))
     data = read(stream, int(cmdlen))
     try:
         return json.loads(data)
@@ -27,3 +101,21 @@ def read_cmd(stream):
         print data
         raise e
 
+
+# Chunks go into one buffer as they come, which marshal reads in
+# place: the payload is held once, not as chunks plus a joined copy.
+# It is still held whole; z3 parses a query from one string.
+def read_binary(stream, flags):
+    z = zlib.decompressobj() if flags & FLAG_ZLIB else None
+    data = bytearray()
+    while True:
+        n, = CHUNK_LEN.unpack(read_exact(stream, CHUNK_LEN.size))
+        if n == 0:
+            break
+        chunk = read_exact(stream, n)
+        if z:
+            chunk = z.decompress(chunk)
+        data += chunk
+    if z:
+        data += z.flush()
+    return marshal.loads(buffer(data))
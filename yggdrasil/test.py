@@ -1,6 +1,7 @@
 import os
 import copy
 import sys
+import time
 import signal
 import unittest
 import subprocess
@@ -12,12 +13,33 @@ from unittest.case import (
 import disk
 import multiprocessing as mp
 
-from z3 import And, Implies, ForAll, BoolRef, Not, Solver, unsat, unknown, Z3Exception
+from z3 import And, Implies, ForAll, BoolRef, Not, Solver, sat, unsat, unknown, Z3Exception
 
 from diskspec import Machine
 from util import prove, solve
+import util
 
+import cache
+import explore
+import report
 import solver
+import ufarray
+
+
+# Simplify queries before solving: 'simplify', 'ctx-simplify' or
+# 'ctx-solver-simplify' (see util.Simplifier).
+SIMPLIFY = os.getenv('YGGDRASIL_SIMPLIFY')
+
+_simplifier = None
+
+
+def simplify_query(terms):
+    global _simplifier
+    if not SIMPLIFY:
+        return terms
+    if _simplifier is None:
+        _simplifier = util.Simplifier(SIMPLIFY)
+    return _simplifier.conjuncts(terms)
 
 
 def z3_option(**kwargs):
@@ -33,21 +55,57 @@ def fork_bool(test):
     def inner(self):
         pid = os.fork()
         if pid:
+            start = time.time()
             os.waitpid(pid, 0)
+            # Time spent on the other branch does not count for this one
+            test._start += time.time() - start
+            test._path += '1'
             disk.assertion(self)
             return True
         else:
+            test._path += '0'
             disk.assertion(Not(self))
             return False
     return inner
 
 
+def explore_bool(test):
+    def inner(self):
+        taken = test._explorer.branch(self)
+        test._path += '1' if taken else '0'
+        return taken
+    return inner
+
+
 class DiskTest(unittest.TestCase):
+    # Explore the paths of a test in one process, running it once per
+    # path, rather than forking at every branch (see explore.Explorer).
+    WORKLIST = os.getenv('YGGDRASIL_WORKLIST', '0') not in ('', '0')
+
+    # Bounds on the branches of a path and the paths of a test for
+    # WORKLIST (0: no bound); tests going past them error out.
+    MAX_DEPTH = int(os.getenv('YGGDRASIL_MAX_DEPTH', 0))
+    MAX_PATHS = int(os.getenv('YGGDRASIL_MAX_PATHS', 0))
+
+    # Back blocks and disks with z3 arrays (see ufarray.ArrayBlock);
+    # `arrays = True` on a test method (or match_ method) does so for
+    # one test.
+    ARRAYS = ufarray.ARRAYS
+
     def __init__(self, *args, **kwargs):
         super(DiskTest, self).__init__(*args, **kwargs)
         disk.native = False
+        self._explorer = None
+        # 'merged' or 'unmergeable' once _perform tried to merge
+        self._merge = None
 
     def run(self, result, *args, **kwargs):
+        # Start the solver servers here so that every test (and every
+        # path forked off a test) reuses them.  Servers started by the
+        # child below die with its process group.
+        solver.default_pool().warm()
+        self._begin()
+
         parentp, childp = mp.Pipe()
 
         pid = os.fork()
@@ -94,6 +152,8 @@ class DiskTest(unittest.TestCase):
                     pass
         else:
             os.setpgrp()
+            fn = getattr(self, self._testMethodName)
+            ufarray.ARRAYS = self.ARRAYS or getattr(fn, 'arrays', False)
             try:
                 self._run(childp, result, *args, **kwargs)
             except Exception, e:
@@ -102,7 +162,10 @@ class DiskTest(unittest.TestCase):
 
     def _run(self, q, result):
         presult = copy.deepcopy(result)
-        super(DiskTest, self).run(result)
+        if self.WORKLIST:
+            self._explore(result)
+        else:
+            super(DiskTest, self).run(result)
         if (len(presult.errors) < len(result.errors) or
                 len(presult.failures) < len(result.failures)):
             fails = result.failures
@@ -123,8 +186,23 @@ class DiskTest(unittest.TestCase):
 
         q.send([output])
 
+    def _explore(self, result):
+        self._explorer = explore.Explorer(self.MAX_DEPTH, self.MAX_PATHS)
+        run = result.testsRun
+        try:
+            while self._explorer.next():
+                self._begin()
+                super(DiskTest, self).run(result)
+        except explore.PathLimit:
+            result.addError(self, sys.exc_info())
+        # One test, however many paths
+        result.testsRun = run + 1
+
     def enable_symbolic_execution(self):
-        setattr(BoolRef, "__nonzero__", fork_bool(self))
+        if self.WORKLIST:
+            setattr(BoolRef, "__nonzero__", explore_bool(self))
+        else:
+            setattr(BoolRef, "__nonzero__", fork_bool(self))
 
     def setUp(self):
         disk.native = False
@@ -132,6 +210,14 @@ class DiskTest(unittest.TestCase):
         disk.debug.debugs = []
         self.enable_symbolic_execution()
 
+    # Start symbolic execution of a path, for the report: the branches
+    # taken so far, and the time spent building and solving queries.
+    def _begin(self, obligation=None):
+        self._obligation = obligation
+        self._path = ''
+        self._start = time.time()
+        self._solver_time = 0.0
+
     def prove(self, claim, *args, **kwargs):
         model = self._solve(Not(claim), *args, **kwargs)
         self.assertIsNone(model)
@@ -143,71 +229,200 @@ class DiskTest(unittest.TestCase):
     def psolve(self, *args, **kwargs):
         model = self._solve(And(*disk.assertion.assertions), *args, **kwargs)
         if model:
-            print ""
-            for msg, vs in disk.debug.debugs:
-                print msg,
-                for v in vs:
-                    print model.evaluate(v),
-                print ""
-            print ""
+            self._print_debugs(model)
 
         self.assertIsNone(model)
 
     def pprove(self, claim, *args, **kwargs):
         model = self._solve(And(*disk.assertion.assertions), Not(claim), *args, **kwargs)
         if model:
-            print ""
-            for msg, vs in disk.debug.debugs:
-                print msg,
-                for v in vs:
-                    print model.evaluate(v),
-                print ""
-            print ""
+            self._print_debugs(model)
 
         self.assertIsNone(model)
 
+    # Values of the disk.debug terms in a counterexample
+    def _print_debugs(self, model):
+        values = iter(util.evaluate_many(model,
+            [v for _, vs in disk.debug.debugs for v in vs]))
+        print ""
+        for msg, vs in disk.debug.debugs:
+            print msg,
+            for v in vs:
+                print next(values),
+            print ""
+        print ""
+
     def show(self, *args, **kwargs):
         model = self._solve(*args, **kwargs)
         self.assertIsNotNone(model)
         return model
 
     def _solve(self, *args, **keywords):
-        s = solver.Solver()
-
-        s.set(**keywords)
-
-        s.add(*args)
-
         if keywords.get('show', False):
-            print(s)
+            print(solver.to_smt2(*args))
+
+        [(r, s)] = self._check_all([(args, keywords)], [self._obligation])
 
-        smt = os.getenv('SMT')
-        if smt:
-            PIPE = subprocess.PIPE
-            args = [ "{}={}".format(a, str(b).lower()) for a, b in keywords.items() ]
-            p = subprocess.Popen(smt.split() + args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = p.communicate(s.to_smt2())
-            stdout = stdout.strip()
-            if stdout == 'sat':
-                return 'model'
-            elif stdout == 'unsat':
-                r = unsat
-            else:
-                print args
-                print s.to_smt2()
-                r = unknown
-        else:
-            r = s.check()
         if r == unsat:
             return None
         elif r == unknown:
             self.fail("Solver failed to solve")
+        elif s is None:
+            # External solver
+            return 'model'
         else:
             return s.model()
 
+    # Check a list of (terms, options) queries at the same time, each
+    # on its own solver server.  Returns a list of (result, solver);
+    # the solver is None when the result did not come from a server.
+    def _check_all(self, queries, names=None):
+        if self._explorer is not None:
+            out = self._explorer.replay()
+            if out is not None:
+                return out
+        if names is None:
+            names = [None] * len(queries)
+        symex_time = time.time() - self._start - self._solver_time
+        start = time.time()
+
+        results = cache.default_cache()
+        smt = os.getenv('SMT')
+
+        # With a portfolio the external solver is one of the attempts
+        configs = None
+        backend = smt
+        if solver.PORTFOLIO:
+            configs = [solver.CONFIGS[n] for n in solver.PORTFOLIO]
+            if smt:
+                configs.append(solver.Config('smt', smt=smt))
+            backend = repr((smt, solver.PORTFOLIO, solver.TIMEOUT, solver.MEMORY))
+
+        started = []
+        sizes = []
+        hits = set()
+        for raw, options in queries:
+            terms = simplify_query(raw)
+            query = solver.to_smt2(*terms)
+            sizes.append(self._size(terms, query, raw))
+
+            key = None
+            if results:
+                key = cache.key(query, options, backend)
+                r = results.get(key)
+                # Cached sat: solve again to get a model
+                if r in ('unsat', 'unknown'):
+                    hits.add(len(started))
+                    started.append((key, solver.RESULTS[r], None))
+                    continue
+
+            if configs:
+                started.append((key, None, solver.Portfolio(query, options, configs,
+                    profile=bool(report.REPORT))))
+                continue
+
+            if smt:
+                r = self._check_external(smt, query, options)
+                if results:
+                    results.put(key, str(r))
+                started.append((key, r, None))
+                continue
+
+            s = solver.Solver()
+            s.set(**options)
+            if report.REPORT:
+                s.set(**{solver.PROFILE: True})
+            s.add_smt2(query)
+            s.check_async()
+            started.append((key, None, s))
+
+        out = []
+        for i, (key, r, s) in enumerate(started):
+            if s is not None:
+                r = s.wait()
+                if results:
+                    results.put(key, str(r))
+                if isinstance(s, solver.Portfolio):
+                    s = s.winner
+            out.append((r, s))
+            self._record(names[i], sizes[i], r, symex_time,
+                    time.time() - start, i in hits, s)
+        self._solver_time += time.time() - start
+        if self._explorer is not None:
+            # Only the results are needed again
+            self._explorer.remember([(r, None) for r, _ in out])
+        return out
+
+    # (smt2 bytes, AST nodes, AST nodes before simplification)
+    def _size(self, terms, query=None, raw=None):
+        if not report.REPORT:
+            return None
+        if query is None:
+            query = solver.to_smt2(*terms)
+        nodes = report.ast_size(terms)
+        if raw is not None and raw is not terms:
+            return len(query), nodes, report.ast_size(raw)
+        return len(query), nodes, nodes
+
+    def _record(self, name, size, r, symex_time, solver_time, cached=False, s=None):
+        if not report.REPORT:
+            return
+        stats = s.statistics() if s is not None else None
+        test = self.id()
+        if test.startswith('__main__.'):
+            test = os.path.splitext(os.path.basename(sys.argv[0]))[0] + test[8:]
+        report.record(dict(test=test, obligation=name or 'query',
+                path=self._path, branches=len(self._path),
+                symex_time=symex_time, solver_time=solver_time,
+                smt2_bytes=size[0], ast_nodes=size[1], raw_ast_nodes=size[2],
+                result=str(r), cached=cached, statistics=stats,
+                merge=self._merge))
+
+    def _check_external(self, smt, query, keywords):
+        PIPE = subprocess.PIPE
+        args = [ "{}={}".format(a, str(b).lower()) for a, b in keywords.items() ]
+        p = subprocess.Popen(smt.split() + args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate(query)
+        stdout = stdout.strip()
+        if stdout == 'sat':
+            return sat
+        elif stdout == 'unsat':
+            return unsat
+        print args
+        print query
+        return unknown
+
+
+class Obligation(object):
+    def __init__(self, name, expected, options, terms, machs=()):
+        self.name = name
+        self.expected = expected
+        self.options = options
+        self.terms = terms
+        self.machs = machs
+
+
+# Name the quantifiers of an equivalence method after it, so that the
+# instantiation profile in the report tells them apart.
+def _label_equivalence(cls, fn):
+    def inner(self, *args, **kwargs):
+        if not report.REPORT:
+            return fn(self, *args, **kwargs)
+        with util.quantifier_ids('%s.%s' % (cls, fn.__name__)):
+            return fn(self, *args, **kwargs)
+    inner.__name__ = fn.__name__
+    return inner
+
 
 class RefinementMeta(type):
     def __new__(cls, name, parents, dct):
+        labeled = {}
+        for k, v in dct.items():
+            if k.startswith('equivalence') and callable(v):
+                if v not in labeled:
+                    labeled[v] = _label_equivalence(name, v)
+                dct[k] = labeled[v]
+
         for k, v in dct.items():
             if k.startswith('nop_'):
                 fname = k[4:]
@@ -217,8 +432,13 @@ class RefinementMeta(type):
                 fname = k[6:]
                 if not getattr(v, 'nocrash', False):
                     dct['test_%s_crash' % k] = lambda self, fname=fname, fn=v: self._match_fn(fname, fn, True)
+                    dct['test_%s_crash' % k].shared = True
                 dct['test_%s' % k] = lambda self, fname=fname, fn=v: self._match_fn(fname, fn, False)
                 dct['test_%s_pre' % k] = lambda self, fname=fname, fn=v: self._check_pre(fname, fn)
+                dct['test_%s_pre' % k].shared = True
+                for t in ['test_%s' % k, 'test_%s_crash' % k, 'test_%s_pre' % k]:
+                    if t in dct:
+                        dct[t].arrays = getattr(v, 'arrays', False)
 
         return super(RefinementMeta, cls).__new__(cls, name, parents, dct)
 
@@ -227,6 +447,19 @@ class RefinementTest(DiskTest):
     __metaclass__ = RefinementMeta
     DEBUG = False
 
+    # Run each match_ method once in test_match_* and check its pre,
+    # post and crash obligations from there; the _pre and _crash tests
+    # are skipped.
+    SHARED_EXECUTION = os.getenv('YGGDRASIL_SHARED_EXECUTION', '0') not in ('', '0')
+
+    # Like SHARED_EXECUTION, but check the obligations on one solver
+    # through push/pop, sending the shared assertions only once.
+    INCREMENTAL = os.getenv('YGGDRASIL_INCREMENTAL', '0') not in ('', '0')
+
+    # Join the paths of every match_ operation where it returns; see
+    # _perform.  match_X.merge = True does so for one test.
+    MERGE = os.getenv('YGGDRASIL_MERGE', '0') not in ('', '0')
+
     def setUp(self):
         super(RefinementTest, self).setUp()
 
@@ -246,16 +479,26 @@ class RefinementTest(DiskTest):
         if self.DEBUG:
             print args, kwargs
 
+    # Whether this is a _crash or _pre test that test_match_* checks
+    # instead (so verify.py does not run it).
+    def redundant(self):
+        fn = getattr(self, self._testMethodName)
+        return (self.SHARED_EXECUTION or self.INCREMENTAL) and getattr(fn, 'shared', False)
+
     def assumption(self, name, spec_mach, impl_mach):
         return And(spec_mach.assumption,
                    impl_mach.assumption,
                    *disk.assertion.assertions)
 
     def _check_pre(self, fname, fn):
+        if self.redundant():
+            self.skipTest('checked by test_match_%s' % fname)
+
         self._debug('Running', fname, fn)
 
         for args in fn(self):
             self._debug('Iteration', args)
+            self._begin()
 
             disk.native = False
             self.enable_symbolic_execution()
@@ -279,13 +522,20 @@ class RefinementTest(DiskTest):
 
             assumption = self.assumption(fname, spec_mach, impl_mach)
 
+            self._obligation = 'precondition'
             self.show(assumption, pre)
 
     def _match_fn(self, fname, fn, crash):
+        if self.SHARED_EXECUTION or self.INCREMENTAL:
+            if self.redundant():
+                self.skipTest('checked by test_match_%s' % fname)
+            return self._match_all(fname, fn)
+
         self._debug('Running', fname, fn)
 
         for args in fn(self):
             self._debug('Iteration', args)
+            self._begin()
 
             disk.native = False
             self.enable_symbolic_execution()
@@ -308,42 +558,10 @@ class RefinementTest(DiskTest):
 
             self._debug('Pre', pre)
 
-            if hasattr(self, 'call_%s' % fname):
-                rets = getattr(self, 'call_%s' % fname)(spec, impl, args)
-                if rets is None:
-                    rets = (None, None)
-            else:
-                if hasattr(self, 'call_%s_spec' % fname):
-                    rets_spec = getattr(self, 'call_%s_spec' % fname)(spec, args)
-                else:
-                    # Guess something sensible..
-                    if hasattr(spec, 'begin_tx'):
-                        spec.begin_tx()
-                    rets_spec = getattr(spec, fname)(*args)
-                    if hasattr(spec, 'commit_tx'):
-                        spec.commit_tx()
-
-                if hasattr(self, 'call_%s_impl' % fname):
-                    rets_impl = getattr(self, 'call_%s_impl' % fname)(impl, args)
-                else:
-                    # Guess something sensible..
-                    if hasattr(impl, 'begin_tx'):
-                        impl.begin_tx()
-                    rets_impl = getattr(impl, fname)(*args)
-                    if hasattr(impl, 'commit_tx'):
-                        impl.commit_tx()
-
-                rets = (rets_spec, rets_impl)
+            rets = self._perform(fn, fname, spec, impl, args)
 
             if crash:
-                if hasattr(self, 'crash_impl'):
-                    impl = self.crash_impl(impl)
-                else:
-                    impl = impl.crash(Machine())
-                if hasattr(self, 'crash_spec'):
-                    spec = self.crash_spec(spec)
-                else:
-                    spec = spec.crash(Machine())
+                spec, impl = self._crash(spec, impl)
 
             post = pp.send((spec, impl, args, rets))
 
@@ -355,6 +573,7 @@ class RefinementTest(DiskTest):
             if self.DEBUG or getattr(fn, 'debug', False):
                 self._debug('Precondition sat', self.show(pre))
 
+            self._obligation = 'crash refinement' if crash else 'refinement'
             if crash:
                 opt = {
                     'AUTO_CONFIG': False,
@@ -365,20 +584,11 @@ class RefinementTest(DiskTest):
 
                 if spec_mach.control:
                     model = self._solve(assumption,
-                        ForAll(spec_mach.control, Not(Implies(pre, post))), **opt)
+                        ForAll(spec_mach.control, Not(Implies(pre, post)), qid='crash'), **opt)
                 else:
                     model = self._solve(assumption, Not(Implies(pre, post)), **opt)
                 if model:
-                    print ""
-                    for msg, vs in disk.debug.debugs:
-                        print msg,
-                        for v in vs:
-                            print model.evaluate(v),
-                        print ""
-                    print ""
-
-                    spec_mach.explain(model)
-                    impl_mach.explain(model)
+                    self._explain(model, spec_mach, impl_mach)
                 self.assertIsNone(model)
             else:
                 opt = {
@@ -388,11 +598,224 @@ class RefinementTest(DiskTest):
 
                 self.psolve(And(*spec_mach.control), And(*impl_mach.control), Not(Implies(pre, post)), **opt)
 
+    # Run the operation of a match_ method.  With MERGE (or match_X.merge
+    # set), its paths are joined where it returns (see explore.merge):
+    # fewer, larger obligations.  It falls back to one path per branch
+    # if the paths do not join.
+    def _perform(self, fn, fname, spec, impl, args):
+        if self.MERGE or getattr(fn, 'merge', False):
+            try:
+                rets = explore.merge(
+                        lambda spec, impl, args: self._call(fname, spec, impl, args),
+                        spec, impl, args)
+                self._merge = 'merged'
+                return rets
+            except explore.Unmergeable, e:
+                self._merge = 'unmergeable'
+                self._debug('Unmergeable', fname, e)
+        return self._call(fname, spec, impl, args)
+
+    def _call(self, fname, spec, impl, args):
+        if hasattr(self, 'call_%s' % fname):
+            rets = getattr(self, 'call_%s' % fname)(spec, impl, args)
+            if rets is None:
+                rets = (None, None)
+            return rets
+
+        if hasattr(self, 'call_%s_spec' % fname):
+            rets_spec = getattr(self, 'call_%s_spec' % fname)(spec, args)
+        else:
+            # Guess something sensible..
+            if hasattr(spec, 'begin_tx'):
+                spec.begin_tx()
+            rets_spec = getattr(spec, fname)(*args)
+            if hasattr(spec, 'commit_tx'):
+                spec.commit_tx()
+
+        if hasattr(self, 'call_%s_impl' % fname):
+            rets_impl = getattr(self, 'call_%s_impl' % fname)(impl, args)
+        else:
+            # Guess something sensible..
+            if hasattr(impl, 'begin_tx'):
+                impl.begin_tx()
+            rets_impl = getattr(impl, fname)(*args)
+            if hasattr(impl, 'commit_tx'):
+                impl.commit_tx()
+
+        return (rets_spec, rets_impl)
+
+    def _crash(self, spec, impl):
+        if hasattr(self, 'crash_impl'):
+            impl = self.crash_impl(impl)
+        else:
+            impl = impl.crash(Machine())
+        if hasattr(self, 'crash_spec'):
+            spec = self.crash_spec(spec)
+        else:
+            spec = spec.crash(Machine())
+        return spec, impl
+
+    def _explain(self, model, *machs):
+        self._print_debugs(model)
+
+        for mach in machs:
+            mach.explain(model)
+
+    # Run match_ once and check all of its obligations: the
+    # precondition before the operation, then the refinement and crash
+    # refinement obligations on each path.  The obligations keep the
+    # assumptions they have in _check_pre and _match_fn.
+    def _match_all(self, fname, fn):
+        self._debug('Running', fname, fn)
+
+        crash = not getattr(fn, 'nocrash', False)
+
+        opt = dict(getattr(fn, '_z3_options', {}))
+        crash_opt = {'AUTO_CONFIG': False}
+        crash_opt.update(opt)
+
+        for args in fn(self):
+            self._debug('Iteration', args)
+            self._begin()
+
+            disk.native = False
+            self.enable_symbolic_execution()
+            disk.assertion.assertions = []
+            disk.debug.debugs = []
+
+            spec_mach = Machine()
+            impl_mach = Machine()
+
+            spec = self.create_spec(spec_mach)
+            self.assertIsNotNone(spec)
+            impl = self.create_impl(impl_mach)
+            self.assertIsNotNone(impl)
+
+            kwargs = dict(spec=spec, impl=impl,
+                    spec_mach=spec_mach, impl_mach=impl_mach,
+                    fnargs=args, fname=fname, pre=False)
+            pp = self.pre_post(crash=False, **kwargs)
+            pre = pp.next()
+            # What the crash obligation alone assumes
+            crash_assumed = []
+            if crash:
+                n = len(disk.assertion.assertions)
+                crash_pp = self.pre_post(crash=True, **kwargs)
+                crash_pre = crash_pp.next()
+                crash_assumed += disk.assertion.assertions[n:]
+                del disk.assertion.assertions[n:]
+
+            self._debug('Pre', pre)
+
+            shared = list(disk.assertion.assertions)
+
+            session = None
+            if self.INCREMENTAL:
+                # The shared assertions hold on every path and are sent
+                # once; all checks use the same options.
+                session = solver.Solver()
+                session.set(**(crash_opt if crash else opt))
+                if report.REPORT:
+                    session.set(**{solver.PROFILE: True})
+                session.add(*shared)
+
+            # Checked before running the operation, so only once
+            # rather than once per path.
+            self._discharge(session, shared, [
+                Obligation('precondition', sat, {},
+                    [spec_mach.assumption, impl_mach.assumption, pre])])
+
+            rets = self._perform(fn, fname, spec, impl, args)
+            nop = len(disk.assertion.assertions)
+
+            # Crash from the states right after the operation, as in
+            # _match_fn, not from what computing `post` leaves.
+            if crash:
+                crash_spec, crash_impl = self._crash(spec, impl)
+                crash_assumed += disk.assertion.assertions[nop:]
+                del disk.assertion.assertions[nop:]
+
+            post = pp.send((spec, impl, args, rets))
+
+            if crash:
+                npost = len(disk.assertion.assertions)
+                crash_post = crash_pp.send((crash_spec, crash_impl, args, rets))
+                crash_assumed += disk.assertion.assertions[npost:]
+                del disk.assertion.assertions[npost:]
+
+            self._debug('Post', post)
+
+            if self.DEBUG or getattr(fn, 'debug', False):
+                self._debug('Precondition sat', self.show(pre))
+
+            obligations = [
+                Obligation('refinement', unsat, opt,
+                    [And(*spec_mach.control), And(*impl_mach.control),
+                     Not(Implies(pre, post))] +
+                    disk.assertion.assertions[len(shared):])]
+
+            if crash:
+                if spec_mach.control:
+                    goal = ForAll(spec_mach.control, Not(Implies(crash_pre, crash_post)), qid='crash')
+                else:
+                    goal = Not(Implies(crash_pre, crash_post))
+
+                obligations.append(Obligation('crash refinement', unsat, crash_opt,
+                    [spec_mach.assumption, impl_mach.assumption, goal] +
+                    disk.assertion.assertions[len(shared):nop] + crash_assumed,
+                    machs=(spec_mach, impl_mach)))
+
+            self._discharge(session, shared, obligations)
+
+    def _discharge(self, session, shared, obligations):
+        if session is None:
+            checked = self._check_all([(shared + o.terms, o.options) for o in obligations],
+                    [o.name for o in obligations])
+            for o, (r, s) in zip(obligations, checked):
+                self._verdict(o, r, s)
+            return
+
+        if self._explorer is not None:
+            checked = self._explorer.replay()
+            if checked is not None:
+                for o, (r, _) in zip(obligations, checked):
+                    self._verdict(o, r, None)
+                return
+
+        # Forked paths share the session with their parent, so every
+        # check has to leave it at the shared level.
+        checked = []
+        for o in obligations:
+            symex_time = time.time() - self._start - self._solver_time
+            start = time.time()
+            session.push()
+            try:
+                session.add(*o.terms)
+                r = session.check()
+                # Only what is sent on top of the shared assertions
+                self._record(o.name, self._size(o.terms), r, symex_time,
+                        time.time() - start, s=session)
+                self._solver_time += time.time() - start
+                self._verdict(o, r, session)
+                checked.append((r, None))
+            finally:
+                session.pop()
+        if self._explorer is not None:
+            self._explorer.remember(checked)
+
+    def _verdict(self, o, r, s):
+        if r == unknown:
+            self.fail("Solver failed to solve")
+        if r == sat and r != o.expected and s is not None:
+            self._explain(s.model(), *o.machs)
+        self.assertEqual(r, o.expected, '%s failed' % o.name)
+
     def _nop_fn(self, fname, fn, crash):
         self._debug('Running', fname, fn)
 
         for args in fn(self):
             self._debug('Iteration', args)
+            self._begin()
 
             disk.native = False
             self.enable_symbolic_execution()
@@ -448,6 +871,7 @@ class RefinementTest(DiskTest):
             if self.DEBUG or getattr(fn, 'debug', False):
                 self._debug('Precondition sat', self.show(pre))
 
+            self._obligation = 'crash refinement' if crash else 'refinement'
             if crash:
                 opt = {
                     'AUTO_CONFIG': False,
@@ -458,16 +882,7 @@ class RefinementTest(DiskTest):
                 model = self._solve(assumption, Not(Implies(pre, post)), **opt)
 
                 if model:
-                    print ""
-                    for msg, vs in disk.debug.debugs:
-                        print msg,
-                        for v in vs:
-                            print model.evaluate(v),
-                        print ""
-                    print ""
-
-                    spec_mach.explain(model)
-                    impl_mach.explain(model)
+                    self._explain(model, spec_mach, impl_mach)
                 self.assertIsNone(model)
             else:
                 opt = {
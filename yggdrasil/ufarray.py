@@ -1,9 +1,68 @@
+import z3
 from z3 import *
 from util import *
 import copy
+import os
 import warnings
 
 
+# Back new blocks and disks with z3 arrays (Select/Store) rather than
+# uninterpreted functions and a log of If-terms; see ArrayBlock and
+# ArrayDiskArray.  DiskTest sets it per test (YGGDRASIL_ARRAYS, or
+# `arrays = True` on a test or match_ method).
+ARRAYS = os.getenv('YGGDRASIL_ARRAYS', '0') not in ('', '0')
+
+
+# Writes to a Block, DiskArray or UFunction are kept in a log, newest
+# first: (write, older log).  A write takes the key read and the term
+# for the contents before it, and returns the term after it.  Reads
+# walk the log in a loop rather than through nested closures, and
+# remember the term for each base and key along with the log it is
+# for; a longer log (such as after one more write) extends it.  The
+# memo is not part of any object, so that explore.merge neither saves
+# nor joins it.
+_memo = {}
+
+
+def _read(base, log, key):
+    ids = (id(base),) + tuple(k.get_id() for k in key)
+    hit = _memo.get(ids)
+    writes = []
+    cell = log
+    while cell is not None and (hit is None or cell is not hit[2]):
+        writes.append(cell[0])
+        cell = cell[1]
+    if hit is not None and cell is hit[2]:
+        term = hit[3]
+    else:
+        term = base(*key)
+    for write in reversed(writes):
+        term = write(key, term)
+    # The base and key keep their ids in use
+    _memo[ids] = (base, key, log, term)
+    return term
+
+
+# The contents as of this log; later writes do not change it.
+def _reader(base, log):
+    return lambda *key: _read(base, log, key)
+
+
+# Whether a write at `written` is seen by a read at `key`, when the
+# keys are concrete (such as the fixed offsets of a log header): False
+# if a pair of concrete keys differ, True if all of them are the same,
+# None otherwise (leave it to the solver).
+def _same_key(key, written):
+    same = True
+    for k, w in zip(key, written):
+        if is_bv_value(k) and is_bv_value(w):
+            if k.as_long() != w.as_long():
+                return False
+        else:
+            same = None
+    return same
+
+
 # immutable string: an array of u64s (represented using UF)
 StringOffsetSort = SizeSort
 StringElementSort = BlockElementSort
@@ -18,7 +77,8 @@ class String(object):
         off = FreshSize('off', domain=StringOffsetSort)
         size = self.size()
         return And(size == other.size(),
-                   ForAll([off], Implies(ULT(off, size), self[off] == other[off])))
+                   ForAll([off], Implies(ULT(off, size), self[off] == other[off]),
+                          qid='String.eq'))
 
     def __ne__(self, other):
         return Not(self == other)
@@ -37,15 +97,35 @@ class String(object):
 # mutable - easy to extract to C
 class Block(object):
     def __init__(self, fn):
-        self._fn = fn
+        self._base = fn
+        self._log = None
 
-    def __getitem__(self, key):
+    @property
+    def _fn(self):
+        return _reader(self._base, self._log)
+
+    def _offset(self, key):
         if type(key) is int:
             key = BitVecVal(key, BlockOffsetSort)
 
         assert key.size() == BlockOffsetSort.size()
+        return key
 
-        return self._fn(key)
+    def _value(self, val):
+        if type(val) is int:
+            val = BitVecVal(val, BlockElementSort)
+
+        if val.size() < BlockElementSort.size():
+            warnings.warn("Block element %s (%s) smaller then expected (%s)." %
+                    (val, val.size(), BlockElementSort.size()))
+            val = ZeroExt(BlockElementSort.size() - val.size(), val)
+
+        assert val.size() == BlockElementSort.size()
+        return val
+
+    def __getitem__(self, key):
+        key = self._offset(key)
+        return _read(self._base, self._log, (key,))
 
     def get(self, bid):
         return self[bid]
@@ -55,26 +135,22 @@ class Block(object):
 
     def ite(self, other, cond):
         # If cond then self else other
-        fn = lambda off, oldfn=self._fn: If(cond,
+        fn = lambda off, oldfn=self._fn, otherfn=other._fn: If(cond,
                 oldfn(off),
-                other._fn(off))
+                otherfn(off))
         return Block(fn)
 
     def __setitem__(self, key, val):
-        if type(key) is int:
-            key = BitVecVal(key, BlockOffsetSort)
-        if type(val) is int:
-            val = BitVecVal(val, BlockElementSort)
+        key = self._offset(key)
+        val = self._value(val)
 
-        if val.size() < BlockElementSort.size():
-            warnings.warn("Block element %s (%s) smaller then expected (%s)." %
-                    (val, val.size(), BlockElementSort.size()))
-            val = ZeroExt(BlockElementSort.size() - val.size(), val)
-
-        assert key.size() == BlockOffsetSort.size()
-        assert val.size() == BlockElementSort.size()
+        def write((off,), old):
+            same = _same_key((off,), (key,))
+            if same is None:
+                return If(off == key, val, old)
+            return val if same else old
 
-        self._fn = lambda off, oldfn=self._fn: If(off == key, val, oldfn(off))
+        self._log = (write, self._log)
 
     def set(self, key, val):
         self[key] = val
@@ -95,18 +171,22 @@ class Block(object):
         data = lambda off, fn=self._fn: If(ULT(off, size), fn(Extract(BlockOffsetSort.size() - 1, 0, off + start)), BitVecVal(0, StringElementSort.size()))
         return String(size, data)
 
-    def setrange(self, start, s):
+    def _range(self, start, s):
         if type(start) is int:
             start = BitVecVal(start, BlockOffsetSort.size())
         else:
             assert start.size() == BlockOffsetSort.size()
         zdiff = StringOffsetSort.size() - BlockOffsetSort.size()
         size = s.size()
-        self._fn = lambda off, oldfn=self._fn: If(And(ULE(start, off), ULT(ZeroExt(zdiff, off - start), size)), s[ZeroExt(zdiff, off - start)], oldfn(off))
+        return lambda off, old: If(And(ULE(start, off), ULT(ZeroExt(zdiff, off - start), size)), s[ZeroExt(zdiff, off - start)], old)
+
+    def setrange(self, start, s):
+        write = self._range(start, s)
+        self._log = (lambda (off,), old: write(off, old), self._log)
 
     def __eq__(self, other):
         off = Const(fresh_name('off'), BlockOffsetSort)
-        return ForAll([off], self[off] == other[off])
+        return ForAll([off], self[off] == other[off], qid='Block.eq')
 
     def __ne__(self, other):
         return Not(self.__eq__(other))
@@ -126,9 +206,14 @@ class Block(object):
 class DiskArray(object):
     def __init__(self, fn, domain=SizeSort):
         self._domain = domain
-        self._fn = fn
+        self._base = fn
+        self._log = None
 
-    def __call__(self, key):
+    @property
+    def _fn(self):
+        return _reader(self._base, self._log)
+
+    def _key(self, key):
         if type(key) is int:
             key = BitVecVal(key, self._domain)
 
@@ -141,55 +226,151 @@ class DiskArray(object):
             print "key.size() = {} != self._domain.size() = {}".format(key.size(),
                                                                        self._domain.size())
             assert key.size() == self._domain.size()
+        return key
 
+    def __call__(self, key):
+        key = self._key(key)
         return Block(lambda off, fn=self._fn: fn(key, off))
 
     def update(self, key, val, *guard):
-        if type(key) is int:
-            key = BitVecVal(key, self._domain)
-
-        if key.size() > self._domain.size():
-            warnings.warn("Disk key %s (%s) larger then expected (%s)." %
-                    (key, key.size(), self._domain.size()))
-            key = Extract(self._domain.size() - 1, 0, key)
-
-        if key.size() != self._domain.size():
-            print "key.size() = {} != self._domain.size() = {}".format(key.size(),
-                                                                       self._domain.size())
-            assert key.size() == self._domain.size()
+        key = self._key(key)
         assert isinstance(val, Block)
 
         # filter out None
         guard = [g for g in guard if g is not None]
         # make a copy of the block; a shallow copy is fine
-        # as _fn is the only field
+        # as the log is immutable
         val = copy.copy(val)
-        fn = lambda bid, off, oldfn=self._fn: If(And(bid == key, *guard), val[off], oldfn(bid, off))
-        return DiskArray(fn, domain=self._domain)
+
+        def write((bid, off), old):
+            same = _same_key((bid,), (key,))
+            if same is None:
+                return If(And(bid == key, *guard), val[off], old)
+            if not same:
+                return old
+            if len(guard) > 1:
+                return If(And(*guard), val[off], old)
+            if guard:
+                return If(guard[0], val[off], old)
+            return val[off]
+
+        out = copy.copy(self)
+        out._log = (write, self._log)
+        return out
 
     def ite(self, other, cond):
         # If cond then self else other
         # NB: don't eval here to match our C code - the result is _mutable_
-        fn = lambda bid, off: If(cond, self._fn(bid, off), other._fn(bid, off))
+        fn = lambda bid, off, selffn=self._fn, otherfn=other._fn: If(cond, selffn(bid, off), otherfn(bid, off))
         return DiskArray(fn, domain=self._domain)
 
     def domain(self):
         return self._domain
 
 
+# The array of a block.  A block that is not backed by an array gets
+# a fresh one, equal to it at every offset (asserted, as z3 4.4.2 has
+# no lambdas).
+def _as_array(blk):
+    if isinstance(blk, ArrayBlock):
+        return blk._array
+    import disk
+    a = Array(fresh_name('blk'), BlockOffsetSort, BlockElementSort)
+    off = Const(fresh_name('off'), BlockOffsetSort)
+    disk.assertion(ForAll([off], Select(a, off) == blk[off], qid='Block.array'))
+    return a
+
+
+# A Block backed by a z3 array: reads are Selects and writes Stores,
+# and blocks compare by extensionality rather than with a quantifier.
+class ArrayBlock(Block):
+    def __init__(self, array):
+        self._array = array
+
+    @property
+    def _fn(self):
+        return lambda off, a=self._array: Select(a, off)
+
+    def __getitem__(self, key):
+        return Select(self._array, self._offset(key))
+
+    def __setitem__(self, key, val):
+        self._array = Store(self._array, self._offset(key), self._value(val))
+
+    def ite(self, other, cond):
+        if not isinstance(other, ArrayBlock):
+            return super(ArrayBlock, self).ite(other, cond)
+        return ArrayBlock(z3.If(cond, self._array, other._array))
+
+    def setrange(self, start, s):
+        write = self._range(start, s)
+        size = s.size()
+        if is_bv_value(size) and (type(start) is int or is_bv_value(start)):
+            start = start if type(start) is int else start.as_long()
+            for i in range(start, min(start + size.as_long(), self.size)):
+                off = BitVecVal(i, BlockOffsetSort)
+                self._array = Store(self._array, off, write(off, self[off]))
+        else:
+            self._array = _as_array(Block(lambda off, a=self._array: write(off, Select(a, off))))
+
+    def __eq__(self, other):
+        if not isinstance(other, ArrayBlock):
+            return super(ArrayBlock, self).__eq__(other)
+        return self._array == other._array
+
+
+# A DiskArray backed by a z3 array of block arrays.
+class ArrayDiskArray(DiskArray):
+    def __init__(self, array, domain=SizeSort):
+        self._domain = domain
+        self._array = array
+
+    @property
+    def _fn(self):
+        return lambda bid, off, a=self._array: Select(Select(a, bid), off)
+
+    def __call__(self, key):
+        return ArrayBlock(Select(self._array, self._key(key)))
+
+    def update(self, key, val, *guard):
+        key = self._key(key)
+        assert isinstance(val, Block)
+
+        val = _as_array(val)
+        guard = [g for g in guard if g is not None]
+        if len(guard) > 1:
+            val = z3.If(And(*guard), val, Select(self._array, key))
+        elif guard:
+            val = z3.If(guard[0], val, Select(self._array, key))
+
+        return ArrayDiskArray(Store(self._array, key, val), domain=self._domain)
+
+    def ite(self, other, cond):
+        if not isinstance(other, ArrayDiskArray):
+            return super(ArrayDiskArray, self).ite(other, cond)
+        return ArrayDiskArray(z3.If(cond, self._array, other._array), domain=self._domain)
+
+
 def FreshSize(prefix, domain=SizeSort):
     return Const(fresh_name(prefix), domain)
 
 
 def FreshDiskArray(prefix, domain=SizeSort):
+    if ARRAYS:
+        return ArrayDiskArray(Array(fresh_name(prefix), domain,
+            ArraySort(BlockOffsetSort, BlockElementSort)), domain=domain)
     return DiskArray(Function(fresh_name(prefix), domain, BlockOffsetSort, BlockElementSort), domain=domain)
 
 
 def ConstDiskArray(blk, domain=SizeSort):
+    if ARRAYS:
+        return ArrayDiskArray(K(domain, _as_array(blk)), domain=domain)
     return DiskArray(lambda bid, off: blk[off], domain=domain)
 
 
 def FreshBlock(prefix):
+    if ARRAYS:
+        return ArrayBlock(Array(fresh_name(prefix), BlockOffsetSort, BlockElementSort))
     return Block(Function(fresh_name(prefix), BlockOffsetSort, BlockElementSort))
 
 
@@ -199,6 +380,8 @@ def ConstBlock(v):
 
     assert v.size() == BlockElementSort.size()
 
+    if ARRAYS:
+        return ArrayBlock(K(BlockOffsetSort, v))
     return Block(lambda off: v)
 
 
@@ -240,6 +423,16 @@ class UFunction(object):
         else:
             self._fn = Function(name, *args)
 
+    # Replacing the function drops the updates made so far
+    @property
+    def _fn(self):
+        return _reader(self._base, self._log)
+
+    @_fn.setter
+    def _fn(self, fn):
+        self._base = fn
+        self._log = None
+
     def __call__(self, *key):
         assert len(key) == len(self._domain)
 
@@ -251,7 +444,7 @@ class UFunction(object):
 
             assert key[n].size() == self._domain[n].size()
 
-        return self._fn(*key)
+        return _read(self._base, self._log, tuple(key))
 
     def update(self, key, val, guard=True):
         if not isinstance(key, tuple) and not isinstance(key, list):
@@ -267,12 +460,26 @@ class UFunction(object):
 
             assert key[n].size() == self._domain[n].size()
 
-        pfn = self._fn
+        def write(args, old):
+            same = _same_key(args, key)
+            if same is None:
+                return If(And(guard, tup_eq(args, key)), val, old)
+            if not same:
+                return old
+            if guard is True:
+                return val
+            return If(guard, val, old)
 
-        fn = lambda *args: If(And(guard, tup_eq(args, key)), val, pfn(*args))
 
-        args = list(self._domain) + [self._range]
+        out = copy.copy(self)
+        out._log = (write, self._log)
+        return out
 
+    def ite(self, other, cond):
+        # If cond then self else other
+        selffn, otherfn = self._fn, other._fn
+        fn = lambda *args: If(cond, selffn(*args), otherfn(*args))
+        args = list(self._domain) + [self._range]
         return UFunction(self._name, *args, fn=fn)
 
 
@@ -2,6 +2,8 @@ import z3
 
 from z3 import *
 import collections
+import contextlib
+import itertools
 import os, sys, subprocess
 import types
 
@@ -10,9 +12,6 @@ Z3_LIBRARY_PATH = os.environ.get('Z3_LIBRARY_PATH')
 if Z3_LIBRARY_PATH:
     z3.init(Z3_LIBRARY_PATH)
 
-sys.setrecursionlimit(9999)
-
-
 def nop(*args, **kwargs):
     pass
 setattr(z3.AstRef, '__del__', nop)
@@ -95,6 +94,124 @@ def fresh_name(name):
     return name + "." + str(n)
 
 
+# Values of terms in a model, as strings.  A model from a solver server
+# (solver.ModelProxy) evaluates all of them in one round trip.
+def evaluate_many(model, terms):
+    exprs = [t for t in terms if z3.is_expr(t)]
+    if hasattr(model, 'evaluate_many'):
+        values = iter(model.evaluate_many(exprs))
+    else:
+        values = iter([str(model.evaluate(t)) for t in exprs])
+    return [next(values) if z3.is_expr(t) else str(t) for t in terms]
+
+
+# Quantifiers created in the block without a qid get prefix@0,
+# prefix@1, ...  The qid shows up in z3's instantiation profile
+# (smt.qi.profile).  z3 shares structurally equal quantifiers whatever
+# their qid, so it has to be set when a quantifier is first created.
+@contextlib.contextmanager
+def quantifier_ids(prefix):
+    mk = z3.z3._mk_quantifier
+    n = itertools.count()
+
+    def inner(is_forall, vs, body, weight=1, qid="", skid="", patterns=[], no_patterns=[]):
+        if not qid:
+            qid = '%s@%d' % (prefix, next(n))
+        return mk(is_forall, vs, body, weight, qid, skid, patterns, no_patterns)
+
+    z3.z3._mk_quantifier = inner
+    try:
+        yield
+    finally:
+        z3.z3._mk_quantifier = mk
+
+
+# Simplifies the conjuncts of formulas.  With 'simplify', the result
+# of every Boolean subterm is remembered: forked paths share their
+# assertions up to the last branch, and their goals share the pre and
+# post conditions, so most subterms come back again and again.  The
+# tactics 'ctx-simplify' and 'ctx-solver-simplify' use the other
+# conjuncts as context, so they run on the whole query instead.  Other
+# tactics may not preserve equivalence (e.g., solve-eqs drops the
+# equations it solves), which the callers rely on.
+class Simplifier(object):
+    TACTICS = ('simplify', 'ctx-simplify', 'ctx-solver-simplify')
+
+    # Rebuilt from their simplified children
+    CONNECTIVES = {
+        z3.Z3_OP_AND: z3.And,
+        z3.Z3_OP_OR: z3.Or,
+        z3.Z3_OP_NOT: z3.Not,
+        z3.Z3_OP_IMPLIES: z3.Implies,
+        z3.Z3_OP_XOR: z3.Xor,
+        z3.Z3_OP_IFF: lambda a, b: a == b,
+        z3.Z3_OP_EQ: lambda a, b: a == b,
+        z3.Z3_OP_ITE: z3.If,
+    }
+
+    def __init__(self, tactic='simplify'):
+        if tactic not in self.TACTICS:
+            raise ValueError("Not an equivalence-preserving tactic: %s" % tactic)
+        self.tactic = tactic
+        # AST id -> (term, simplified); the term keeps its id in use
+        self._memo = {}
+
+    def _connective(self, term):
+        return (z3.is_app(term) and term.decl().kind() in self.CONNECTIVES and
+                all(z3.is_bool(c) for c in term.children()))
+
+    # Children first, without recursion: formulas can be deep.
+    def _simplify(self, term):
+        stack = [term]
+        while stack:
+            t = stack[-1]
+            k = t.get_id()
+            if k in self._memo:
+                stack.pop()
+                continue
+            if not self._connective(t):
+                stack.pop()
+                self._memo[k] = (t, z3.simplify(t))
+                continue
+            todo = [c for c in t.children() if c.get_id() not in self._memo]
+            if todo:
+                stack.extend(todo)
+                continue
+            stack.pop()
+            children = [self._memo[c.get_id()][1] for c in t.children()]
+            mk = self.CONNECTIVES[t.decl().kind()]
+            self._memo[k] = (t, z3.simplify(mk(*children)))
+        return self._memo[term.get_id()][1]
+
+    def _goal(self, terms):
+        g = z3.Goal()
+        g.add(*terms)
+        subgoals = z3.Tactic(self.tactic)(g)
+        if len(subgoals) == 1:
+            return list(subgoals[0])
+        return [z3.Or(*[sg.as_expr() for sg in subgoals])]
+
+    def conjuncts(self, terms):
+        terms = [z3.BoolVal(t) if isinstance(t, bool) else t for t in terms]
+        if self.tactic != 'simplify':
+            terms = self._goal(terms)
+        out = []
+        todo = terms[::-1]
+        while todo:
+            t = todo.pop()
+            if z3.is_and(t):
+                todo.extend(reversed(t.children()))
+                continue
+            if self.tactic == 'simplify':
+                t = self._simplify(t)
+            if z3.is_true(t):
+                continue
+            if z3.is_false(t):
+                return [t]
+            out.append(t)
+        return out
+
+
 # def prove(claim, **keywords):
 #     return solve(Not(claim), **keywords)
 